@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# A stand-in for HibiAPI serving synthetic threads, so that the fetcher can be measured without reaching tieba
+
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib import parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PER_PAGE = 30
+SUB_PER_PAGE = 10
+SUB_EMBEDDED = 4
+USERS = 50
+
+
+class Config:
+	def __init__(self, floors=300, sub_density=0.3, sub_max=30, media=0.2, video=0.01, latency=0, jitter=0, errors=0,
+			error_status=500, media_size=32768, seed=0):
+		self.floors = floors
+		self.sub_density = sub_density
+		self.sub_max = sub_max
+		self.media = media
+		self.video = video
+		self.latency = latency
+		self.jitter = jitter
+		self.errors = errors
+		self.error_status = error_status
+		self.media_size = media_size
+		self.seed = seed
+
+
+class Stats:
+	# What was served, collected from every handler thread
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.requests = {}
+			self.errors = 0
+			self.bytes = 0
+			self.latencies = []
+
+	def add(self, endpoint, size, latency, error=False):
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+			self.bytes += size
+			self.latencies.append(latency)
+			if error:
+				self.errors += 1
+
+	def report(self):
+		with self.lock:
+			latencies = sorted(self.latencies)
+			return {
+				'requests': dict(self.requests), 'errors': self.errors, 'bytes': self.bytes,
+				'latency_p50': percentile(latencies, 0.5), 'latency_p99': percentile(latencies, 0.99)}
+
+
+def percentile(values, p):
+	if len(values) == 0:
+		return 0
+	return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def floor_rng(config, tid, floor):
+	# Every floor is generated from its own seed, so pages and subposts agree whichever is asked first
+	return random.Random('%d:%s:%d' % (config.seed, tid, floor))
+
+
+def sub_count(config, tid, floor):
+	rng = floor_rng(config, tid, floor)
+	if floor == 1 or rng.random() >= config.sub_density:
+		return 0
+	return rng.randint(1, max(config.sub_max, 1))
+
+
+def make_content(config, base, rng, n):
+	contents = []
+	for i in range(n):
+		r = rng.random()
+		if r < config.video:
+			contents.append({
+				'type': '5', 'text': 'https://tieba.baidu.com/video/%d' % i,
+				'link': '%s/media/video/%d.mp4' % (base, rng.randrange(1000)), 'src': '%s/media/poster/%d.jpg' % (base, rng.randrange(1000)),
+				'width': '640', 'height': '360', 'size': str(config.media_size * 8)})
+		elif r < config.video + config.media:
+			contents.append({
+				'type': '3', 'origin_src': '%s/media/image/%d.jpg' % (base, rng.randrange(1000)), 'bsize': '640,480',
+				'size': str(config.media_size)})
+		elif r < config.video + config.media + 0.1:
+			# Emoticons by name would point at tieba, big ones carry their own address
+			contents.append({
+				'type': '11', 'dynamic': '%s/media/emoticon/%d.gif' % (base, rng.randint(1, 50)), 'width': '100', 'height': '100'})
+		elif r < config.video + config.media + 0.15:
+			contents.append({'type': '4', 'text': '@user', 'uid': str(1000 + rng.randrange(USERS * 2))})
+		else:
+			contents.append({'type': '0', 'text': 'Synthetic text %d %s' % (i, 'lorem ipsum ' * rng.randint(1, 20))})
+	return contents
+
+
+def make_subpost(config, base, tid, floor, k):
+	rng = random.Random('%d:%s:%d:%d' % (config.seed, tid, floor, k))
+	uid = rng.randrange(USERS)
+	return {
+		'id': str((int(tid) * 100000 + floor) * 1000 + k), 'time': str(1600000000 + floor * 60 + k),
+		'author': {'id': str(1000 + uid), 'name': 'user%d' % uid, 'name_show': 'User %d' % uid, 'portrait': 'portrait%d' % uid},
+		'author_id': str(1000 + uid), 'content': make_content(config, base, rng, rng.randint(1, 2))}
+
+
+def make_post(config, base, tid, floor):
+	rng = floor_rng(config, tid, floor)
+	subs = sub_count(config, tid, floor)
+	return {
+		'id': str(int(tid) * 100000 + floor), 'floor': str(floor), 'time': str(1600000000 + floor * 60),
+		'author_id': str(1000 + rng.randrange(USERS)), 'content': make_content(config, base, rng, rng.randint(1, 6)),
+		'sub_post_number': str(subs),
+		'sub_post_list': {'sub_post_list': [make_subpost(config, base, tid, floor, k) for k in range(min(subs, SUB_EMBEDDED))]}}
+
+
+def make_page(config, base, tid, page, per_page=PER_PAGE):
+	total = max((config.floors + per_page - 1) // per_page, 1)
+	page = min(max(page, 1), total)
+	floors = range((page - 1) * per_page + 1, min(page * per_page, config.floors) + 1)
+	return {
+		'thread': {'title': 'Synthetic thread %s' % tid}, 'forum': {'name': 'benchmark'},
+		'page': {'current_page': str(page), 'total_page': str(total), 'has_more': '1' if page < total else '0'},
+		'post_list': [make_post(config, base, tid, floor) for floor in floors],
+		'user_list': [{
+			'id': str(1000 + i), 'name': 'user%d' % i, 'name_show': 'User %d' % i, 'portrait': 'portrait%d' % i}
+			for i in range(USERS)]}
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_request(True)
+
+	def do_HEAD(self):
+		self.handle_request(False)
+
+	def handle_request(self, body):
+		start = time.perf_counter()
+		config = self.server.config
+		url = parse.urlsplit(self.path)
+		q = dict(parse.parse_qsl(url.query))
+		path = url.path.rstrip('/')
+		endpoint = path.rpartition('/')[2] if not path.startswith('/media/') else 'media'
+		if path == '/stats':
+			return self.send(200, json.dumps(self.server.stats.report()).encode(), body=body)
+		if path == '/stats/reset':
+			self.server.stats.reset()
+			return self.send(200, b'{}', body=body)
+		delay = config.latency + random.uniform(0, config.jitter)
+		if delay > 0:
+			time.sleep(delay)
+		if path == self.server.prefix:
+			# The probe of the fetcher expects a validation error
+			code, data, headers = 422, b'{"detail": "missing endpoint"}', {}
+		elif config.errors > 0 and random.random() < config.errors:
+			code, data, headers = config.error_status, b'{"detail": "injected error"}', {'Retry-After': '0'}
+		else:
+			try:
+				code, data, headers = self.route(path, q)
+			except (KeyError, ValueError):
+				code, data, headers = 422, b'{"detail": "invalid parameters"}', {}
+		size = self.send(code, data, headers, body)
+		self.server.stats.add(endpoint, size, time.perf_counter() - start, error=code >= 500)
+
+	def route(self, path, q):
+		config = self.server.config
+		base = 'http://%s:%d' % self.server.server_address[:2]
+		if path == self.server.prefix + '/post_detail':
+			return 200, json.dumps(make_page(config, base, q['tid'], int(q.get('page', 1)))).encode(), {}
+		elif path == self.server.prefix + '/subpost_detail':
+			tid = q['tid']
+			floor = int(q['pid']) - int(tid) * 100000
+			count = sub_count(config, tid, floor)
+			total = max((count + SUB_PER_PAGE - 1) // SUB_PER_PAGE, 1)
+			page = int(q.get('page', 1))
+			subs = range((page - 1) * SUB_PER_PAGE, min(page * SUB_PER_PAGE, count))
+			return 200, json.dumps({
+				'subpost_list': [make_subpost(config, base, tid, floor, k) for k in subs],
+				'page': {
+					'current_page': str(page), 'total_page': str(total), 'total_count': str(count),
+					'page_size': str(SUB_PER_PAGE)}}).encode(), {}
+		elif path == self.server.prefix + '/user_profile':
+			uid = int(q['uid'])
+			if uid >= 1000 + USERS * 2 - USERS // 2:
+				# Some users mentioned are gone
+				return 404, b'{"detail": "user not found"}', {}
+			return 200, json.dumps({'user': {
+				'id': str(uid), 'name': 'user%d' % (uid - 1000), 'portrait': 'portrait%d' % (uid - 1000)}}).encode(), {}
+		elif path.startswith('/media/'):
+			return self.media(path, config.media_size * (8 if '/video/' in path else 1))
+		return 404, b'{"detail": "not found"}', {}
+
+	def media(self, path, size):
+		seed = hashlib.sha256(path.encode('utf-8')).digest()
+		data = (seed * (size // len(seed) + 1))[:size]
+		etag = '"%s"' % hashlib.sha1(data).hexdigest()
+		headers = {'ETag': etag, 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+		if self.headers.get('If-None-Match') == etag:
+			return 304, b'', headers
+		rng = self.headers.get('Range')
+		if rng is not None and rng.startswith('bytes=') and self.headers.get('If-Range', etag) == etag:
+			start = int(rng[6:].split('-')[0])
+			if start >= size:
+				headers['Content-Range'] = 'bytes */%d' % size
+				return 416, b'', headers
+			headers['Content-Range'] = 'bytes %d-%d/%d' % (start, size - 1, size)
+			return 206, data[start:], headers
+		return 200, data, headers
+
+	def send(self, code, data, headers=None, body=True):
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json' if code != 200 or data[:1] == b'{' else 'application/octet-stream')
+		self.send_header('Content-Length', str(len(data)))
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.end_headers()
+		if body and code != 304:
+			self.wfile.write(data)
+			return len(data)
+		return 0
+
+
+class FakeHibiAPI(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, config, prefix='/api/tieba'):
+		super().__init__(address, Handler)
+		self.config = config
+		self.prefix = prefix
+		self.stats = Stats()
+
+	@property
+	def remote(self):
+		return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], self.prefix)
+
+
+def start(config, host='127.0.0.1', port=0):
+	# Serves in a background thread, returns the server whose remote the fetcher is pointed at
+	server = FakeHibiAPI((host, port), config)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+def add_config_args(parser):
+	parser.add_argument(
+		'--floors', dest='floors', type=int, default=300,
+		help='Generate threads of FLOORS floors, 300 by default')
+	parser.add_argument(
+		'--sub-density', dest='sub_density', type=float, default=0.3,
+		help='Give subposts to a SUB_DENSITY fraction of floors, 0.3 by default')
+	parser.add_argument(
+		'--sub-max', dest='sub_max', type=int, default=30,
+		help='Give up to SUB_MAX subposts to a floor, 30 by default')
+	parser.add_argument(
+		'--media', dest='media', type=float, default=0.2,
+		help='Make a MEDIA fraction of content blocks images, 0.2 by default')
+	parser.add_argument(
+		'--video', dest='video', type=float, default=0.01,
+		help='Make a VIDEO fraction of content blocks videos, 0.01 by default')
+	parser.add_argument(
+		'--media-size', dest='media_size', type=int, default=32768,
+		help='Serve images of MEDIA_SIZE bytes and videos of 8 times as much, 32768 by default')
+	parser.add_argument(
+		'--latency', dest='latency', type=float, default=0,
+		help='Delay every response by LATENCY seconds')
+	parser.add_argument(
+		'--jitter', dest='jitter', type=float, default=0,
+		help='Delay every response by up to JITTER more seconds, at random')
+	parser.add_argument(
+		'--errors', dest='errors', type=float, default=0,
+		help='Fail an ERRORS fraction of requests')
+	parser.add_argument(
+		'--error-status', dest='error_status', type=int, default=500,
+		help='Fail requests with ERROR_STATUS, 500 by default')
+	parser.add_argument(
+		'--seed', dest='seed', type=int, default=0,
+		help='Generate threads from SEED, 0 by default')
+
+
+def config_from_args(args):
+	return Config(
+		floors=args.floors, sub_density=args.sub_density, sub_max=args.sub_max, media=args.media, video=args.video,
+		latency=args.latency, jitter=args.jitter, errors=args.errors, error_status=args.error_status,
+		media_size=args.media_size, seed=args.seed)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve synthetic threads the way HibiAPI does')
+	parser.add_argument(
+		'-p', '--port', dest='port', type=int, default=8765,
+		help='Listen on PORT, 8765 by default')
+	add_config_args(parser)
+	args = parser.parse_args()
+	server = FakeHibiAPI(('127.0.0.1', args.port), config_from_args(args))
+	print('Serving at %s, statistics at /stats' % server.remote, file=sys.stderr)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Parses large synthetic pages of post_detail with each JSON backend available, to measure the cost of parsing alone
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_hibiapi
+from render import load_fetcher
+
+
+def backends(fetcher):
+	# Name: loads, the one the fetcher picked first
+	found = {'fetcher': fetcher.json_loads, 'json': json.loads}
+	try:
+		import orjson
+		found['orjson'] = orjson.loads
+	except ImportError:
+		pass
+	return found
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure how fast responses of HibiAPI are parsed')
+	parser.add_argument(
+		'-n', '--floors', dest='floors', type=int, default=3000,
+		help='Parse pages of FLOORS floors each, 3000 by default')
+	parser.add_argument(
+		'-p', '--pages', dest='pages', type=int, default=4,
+		help='Parse PAGES different pages, 4 by default')
+	parser.add_argument(
+		'-r', '--repeat', dest='repeat', type=int, default=5,
+		help='Parse the pages REPEAT times and report the best, 5 by default')
+	parser.add_argument(
+		'--min-rate', dest='min_rate', type=float, default=0,
+		help='Fail if the backend of the fetcher parses fewer than MIN_RATE MiB per second')
+	args = parser.parse_args()
+	fetcher = load_fetcher()
+	config = fake_hibiapi.Config(floors=args.floors * args.pages, sub_density=0.5, media=0.3, video=0.02)
+	bodies = [
+		json.dumps(fake_hibiapi.make_page(config, 'http://127.0.0.1:8000', '1', page, per_page=args.floors)).encode()
+		for page in range(1, args.pages + 1)]
+	size = sum(len(body) for body in bodies)
+	print('%d pages, %.1f MiB' % (len(bodies), size / 1048576))
+	rates = {}
+	for name, loads in backends(fetcher).items():
+		best = None
+		for i in range(max(args.repeat, 1)):
+			start = time.perf_counter()
+			for body in bodies:
+				loads(body)
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+		rates[name] = size / 1048576 / best
+		print('%-8s %.3f s: %.1f MiB/s, %.1f pages/s' % (name, best, rates[name], len(bodies) / best))
+	if rates['fetcher'] < args.min_rate:
+		print('Slower than %.1f MiB/s' % args.min_rate)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Renders a synthetic post of many content blocks, to measure the cost of rendering alone
+
+import os
+import sys
+import io
+import time
+import random
+import argparse
+import importlib.util
+
+EMOTICONS = ['image_emoticon', 'image_emoticon25', 'i_f12', 'i_f60', 'j_0003', 'b_0012', 'bd_0004', 'ali_051', 'w_0021', 'unknown']
+
+
+def load_fetcher():
+	# The script name is not importable as is
+	file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tieba-thread-fetcher.py')
+	spec = importlib.util.spec_from_file_location('tieba_thread_fetcher', file)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def make_post(blocks, seed=0):
+	rng = random.Random(seed)
+	data = {'user_list': [{'id': str(1000 + i), 'name': 'u%d' % i, 'name_show': 'U%d' % i, 'portrait': 'p%d' % i} for i in range(16)]}
+	contents = []
+	for i in range(blocks):
+		r = rng.random()
+		if r < 0.45:
+			contents.append({'type': '0', 'text': 'text %d\nwith a line break' % i})
+		elif r < 0.6:
+			contents.append({'type': '2', 'text': rng.choice(EMOTICONS), 'c': 'emoticon'})
+		elif r < 0.7:
+			contents.append({'type': '1', 'text': 'link %d' % i, 'link': 'https://example.com/%d' % i})
+		elif r < 0.78:
+			contents.append({'type': '4', 'text': '@user', 'uid': str(1000 + i % 16)})
+		elif r < 0.86:
+			contents.append({
+				'type': '3', 'origin_src': 'https://example.com/img/%d.jpg' % (i % 500), 'bsize': '640,480', 'size': '65536'})
+		elif r < 0.92:
+			contents.append({'type': '11', 'dynamic': 'https://example.com/emo/%d.gif' % (i % 50), 'width': '100', 'height': '100'})
+		elif r < 0.96:
+			contents.append({'type': '7'})
+		else:
+			contents.append({'type': '9', 'text': str(i)})
+	return data, contents
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure how fast content blocks are rendered')
+	parser.add_argument(
+		'-n', '--blocks', dest='blocks', type=int, default=100000,
+		help='Render a post of BLOCKS content blocks, 100000 by default')
+	parser.add_argument(
+		'-r', '--repeat', dest='repeat', type=int, default=5,
+		help='Render the post REPEAT times and report the best, 5 by default')
+	parser.add_argument(
+		'-v', '--verbose', action='store_true', dest='verbose', default=False,
+		help='Also print the messages of every content block, as the fetcher does with -vv')
+	parser.add_argument(
+		'--min-rate', dest='min_rate', type=float, default=0,
+		help='Fail if fewer than MIN_RATE blocks are rendered per second')
+	args = parser.parse_args()
+	fetcher = load_fetcher()
+	# Media are only referred to, nothing is fetched
+	fetcher.no_media = True
+	fetcher.verbosity = 2 if args.verbose else 0
+	data, contents = make_post(args.blocks)
+	best = None
+	size = 0
+	for i in range(max(args.repeat, 1)):
+		buf = io.StringIO()
+		start = time.perf_counter()
+		fetcher.write_content_html(buf.write, data, contents)
+		elapsed = time.perf_counter() - start
+		size = buf.tell()
+		best = elapsed if best is None else min(best, elapsed)
+	rate = args.blocks / best
+	print('%d blocks, %d characters in %.3f s: %.0f blocks/s' % (args.blocks, size, best, rate))
+	if rate < args.min_rate:
+		print('Slower than %.0f blocks/s' % args.min_rate, file=sys.stderr)
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
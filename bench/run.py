@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Runs the fetcher against the bundled stand-in for HibiAPI and reports how it performed in standard scenarios
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_hibiapi
+
+FETCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tieba-thread-fetcher.py')
+
+# Name: (threads, settings of the server, arguments of the fetcher)
+SCENARIOS = {
+	'pages': (5, {'floors': 300, 'sub_density': 0.3, 'media': 0, 'video': 0}, ['-a']),
+	'media': (3, {'floors': 120, 'media': 0.5, 'video': 0.02}, ['--media-workers', '8']),
+	'concurrent': (8, {'floors': 150, 'sub_density': 0.4}, ['-a', '--jobs', '4', '--page-workers', '4', '--sub-workers', '8']),
+	'flaky': (3, {'floors': 150, 'latency': 0.02, 'jitter': 0.02, 'errors': 0.05, 'media': 0, 'video': 0}, [
+		'-a', '--tries', '5', '--backoff', '0.05']),
+}
+
+
+def run_scenario(name, extra, keep=None):
+	threads, settings, args = SCENARIOS[name]
+	server = fake_hibiapi.start(fake_hibiapi.Config(**settings))
+	output = tempfile.mkdtemp(prefix='tieba-bench-')
+	try:
+		tids = [str(1000 + i) for i in range(threads)]
+		cmd = [sys.executable, FETCHER, '-r', server.remote, '-o', output, '-q', '--no-cache'] + args + extra + tids
+		start = time.perf_counter()
+		proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+		# The usage of this very child, not the largest of all children so far
+		_, status, usage = os.wait4(proc.pid, 0)
+		elapsed = time.perf_counter() - start
+		proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+		stats = server.stats.report()
+	finally:
+		server.shutdown()
+		server.server_close()
+		if keep is not None:
+			shutil.copytree(output, os.path.join(keep, name), dirs_exist_ok=True)
+		shutil.rmtree(output, ignore_errors=True)
+	requests = sum(stats['requests'].values())
+	return {
+		'scenario': name, 'threads': threads, 'seconds': elapsed, 'exit_code': proc.returncode,
+		'threads_per_min': threads * 60 / elapsed, 'requests': stats['requests'], 'requests_per_thread': requests / threads,
+		'errors': stats['errors'], 'bytes': stats['bytes'],
+		'latency_p50': stats['latency_p50'], 'latency_p99': stats['latency_p99'],
+		# Kilobytes on Linux, bytes on macOS
+		'peak_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)}
+
+
+# Measure: whether higher is better
+CHECKS = {'threads_per_min': True, 'requests_per_thread': False, 'peak_rss': False}
+
+
+def regressions(results, baseline, tolerance):
+	# Measures of each scenario worse than in BASELINE by more than the fraction TOLERANCE
+	found = []
+	before = {r['scenario']: r for r in baseline}
+	for r in results:
+		b = before.get(r['scenario'])
+		if b is None:
+			continue
+		for key, higher in CHECKS.items():
+			if key not in b or b[key] <= 0:
+				continue
+			change = r[key] / b[key] - 1
+			if (-change if higher else change) > tolerance:
+				found.append('%s: %s %.1f, %+.0f%% from %.1f' % (r['scenario'], key, r[key], change * 100, b[key]))
+	return found
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure the fetcher against a local stand-in for HibiAPI')
+	parser.add_argument(
+		'-s', '--scenario', dest='scenarios', type=str, action='append', default=[], choices=sorted(SCENARIOS),
+		help='Run SCENARIO only, may be given multiple times. Runs every scenario if not specified')
+	parser.add_argument(
+		'-a', '--args', dest='args', type=str, default='',
+		help='Pass ARGS to the fetcher in addition to the arguments of each scenario')
+	parser.add_argument(
+		'-o', '--output', dest='output', type=str, default=None,
+		help='Also write the results to OUTPUT as JSON')
+	parser.add_argument(
+		'-k', '--keep', dest='keep', type=str, default=None,
+		help='Keep the fetched files of each scenario in KEEP')
+	parser.add_argument(
+		'-b', '--baseline', dest='baseline', type=str, default=None,
+		help='Fail if threads per minute drop, or requests per thread or peak RSS grow, '
+			'beyond the tolerance from the results in BASELINE, written earlier with -o')
+	parser.add_argument(
+		'-t', '--tolerance', dest='tolerance', type=float, default=0.2,
+		help='Allow results to be worse than the baseline by a TOLERANCE fraction, 0.2 by default')
+	args = parser.parse_args()
+	baseline = None
+	if args.baseline is not None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	results = []
+	print('%-12s %8s %12s %10s %10s %9s %9s %10s %5s' % (
+		'scenario', 'seconds', 'threads/min', 'req/thread', 'MiB', 'p50 ms', 'p99 ms', 'RSS MiB', 'exit'))
+	for name in args.scenarios or SCENARIOS:
+		r = run_scenario(name, shlex.split(args.args), keep=args.keep)
+		results.append(r)
+		print('%-12s %8.2f %12.1f %10.1f %10.2f %9.2f %9.2f %10.1f %5d' % (
+			name, r['seconds'], r['threads_per_min'], r['requests_per_thread'], r['bytes'] / 1048576,
+			r['latency_p50'] * 1000, r['latency_p99'] * 1000, r['peak_rss'] / 1048576, r['exit_code']))
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2)
+	failed = any(r['exit_code'] != 0 for r in results)
+	if baseline is not None:
+		for line in regressions(results, baseline, args.tolerance):
+			print('Regression in %s' % line, file=sys.stderr)
+			failed = True
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -6,10 +6,30 @@ import argparse
 import requests
 import json
 import time
+import threading
+import tempfile
 import base64
+import hashlib
+import shutil
+import itertools
+import random
+import errno
+import re
+import cProfile
+import pstats
+import email.utils
 import mimetypes
+import zlib
+import queue
+import sqlite3
+import zipfile
+import uuid
 from urllib import parse
-from contextlib import closing
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 try:
 	from tqdm import tqdm
@@ -17,27 +37,682 @@ except ImportError:
 	print('I: Install <tqdm> to have progress bars')
 	no_progress = True
 	tqdm = None
+try:
+	# Parses large pages several times faster, straight from the bytes received
+	from orjson import loads as json_loads
+except ImportError:
+	json_loads = json.loads
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 TIEBA_HOME_PREFIX = 'https://tieba.baidu.com/home/main?id='
 TIEBA_FORUM_PREFIX = 'https://tieba.baidu.com/f?kw='
 TIME_STR = '%Y-%m-%d %H:%M'
+HTML_LINK = '<a href="%s">%s</a>'
+HTML_USER = '<a href="' + TIEBA_HOME_PREFIX + '%s" class="usr">%s</a>'
+HTML_SMILEY = '<img class="BDE_Smiley" pic_type="1" width="30" height="30"'
+HTML_IMAGE = '<img class="BDE_Image" pic_type="0" width="%s" height="%s"'
+HTML_STICKER = '<img class="BDE_Smiley" pic_type="0" width="%s" height="%s"'
+EMOTICON_PREFIX = 'https://tb2.bdstatic.com/tb/editor/images/'
+EMOTICON_SETS = {
+	'j_': ('jd', 'png'),
+	'bearchildren_': ('bearchildren', 'gif'),
+	'tiexing_': ('tiexing', 'gif'),
+	'ali_': ('ali', 'gif'),
+	'llb_': ('luoluobu', 'gif'),
+	'b': ('qpx_n', 'gif'),
+	'xyj_': ('xyj', 'gif'),
+	'ltn_': ('lt', 'gif'),
+	'bfmn_': ('bfmn', 'gif'),
+	'zxh_': ('pczxh', 'gif'),
+	't_': ('tsj', 'gif'),
+	'wdj_': ('wdj', 'gif'),
+	'lxs_': ('lxs', 'gif'),
+	'b_': ('baodong', 'gif'),
+	'bd_': ('baodong_d', 'gif'),
+	'B_': ('bobo', 'gif'),
+	'yz_': ('shadow', 'gif'),
+	'w_': ('ldw', 'gif'),
+	'10th_': ('10th', 'gif'),
+}
+STICKER_SOURCES = {11: (('dynamic', 'image/gif'), ('static', 'image/png')), 20: (('src', 'image/jpeg'),)}
 BUF_SIZE = 4096
 REQ_TIMEOUT = 15
+POOL_HOSTS = 10
+POOL_SIZE = 10
+BACKOFF = 1
+BACKOFF_MAX = 60
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'tieba-thread-fetcher')
+CACHE_SIZE = 1024
+CACHE_TTL_PAGE = 86400
+CACHE_TTL_LAST = 600
+CACHE_TTL_USER = 7 * 86400
+EMBED_CACHE_SIZE = 64
+EMBED_INLINE = 1048576
+EMBED_CHUNK = 3 * 65536
+MEDIA_INDEX = '.media-index.json'
+DUMP_KINDS = ('thread', 'subpost', 'user')
+DUMP_STREAMS = ('.ndjson', '.ndjson.gz', '.ndjson.zst')
+CONTAINER_EXT = {'zip': 'zip', 'warc': 'warc.gz'}
+DB_BATCH = 1000
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS threads (tid TEXT PRIMARY KEY, title TEXT, forum TEXT, pages INTEGER, fetched REAL);
+CREATE TABLE IF NOT EXISTS posts (
+	pid TEXT PRIMARY KEY, tid TEXT NOT NULL, floor INTEGER, author TEXT, time INTEGER, replies INTEGER, content TEXT);
+CREATE TABLE IF NOT EXISTS subposts (
+	spid TEXT PRIMARY KEY, pid TEXT NOT NULL, tid TEXT NOT NULL, author TEXT, time INTEGER, content TEXT);
+CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, name TEXT, portrait TEXT);
+CREATE TABLE IF NOT EXISTS media (tid TEXT NOT NULL, src TEXT NOT NULL, cat TEXT, file TEXT, PRIMARY KEY (tid, src));
+CREATE TABLE IF NOT EXISTS blobs (src TEXT PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS responses (
+	kind TEXT NOT NULL, id TEXT NOT NULL, pid TEXT NOT NULL, page INTEGER NOT NULL, data BLOB, fetched REAL,
+	PRIMARY KEY (kind, id, pid, page));
+CREATE INDEX IF NOT EXISTS posts_tid ON posts (tid, floor);
+CREATE INDEX IF NOT EXISTS posts_author ON posts (author);
+CREATE INDEX IF NOT EXISTS posts_time ON posts (time);
+CREATE INDEX IF NOT EXISTS subposts_tid ON subposts (tid, pid);
+CREATE INDEX IF NOT EXISTS subposts_author ON subposts (author);
+CREATE INDEX IF NOT EXISTS subposts_time ON subposts (time);
+'''
+DB_UPSERT = {
+	'threads': 'INSERT INTO threads VALUES (?, ?, ?, ?, ?) ON CONFLICT (tid) DO UPDATE SET '
+		'title = excluded.title, forum = excluded.forum, pages = excluded.pages, fetched = excluded.fetched',
+	'posts': 'INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (pid) DO UPDATE SET '
+		'floor = excluded.floor, author = excluded.author, time = excluded.time, replies = excluded.replies, '
+		'content = excluded.content',
+	'subposts': 'INSERT INTO subposts VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (spid) DO UPDATE SET '
+		'author = excluded.author, time = excluded.time, content = excluded.content',
+	'users': 'INSERT INTO users VALUES (?, ?, ?) ON CONFLICT (uid) DO UPDATE SET '
+		'name = excluded.name, portrait = excluded.portrait',
+	'media': 'INSERT INTO media VALUES (?, ?, ?, ?) ON CONFLICT (tid, src) DO UPDATE SET '
+		'cat = excluded.cat, file = excluded.file',
+	'blobs': 'INSERT OR IGNORE INTO blobs VALUES (?, ?)',
+	'responses': 'INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (kind, id, pid, page) DO UPDATE SET '
+		'data = excluded.data, fetched = excluded.fetched',
+}
+PROGRESS_INTERVAL = 0.5
+PROGRESS_INTERVAL_PLAIN = 10
+ANSI_ESCAPE = re.compile('\033\\[[0-9;]*m')
 
 remote = 'https://api.obfs.dev/api/tieba'
 interval = 0
 tries = 1
+backoff = BACKOFF
+backoff_max = BACKOFF_MAX
+rates = {}
+limiters = {}
+limiters_lock = threading.Lock()
 no_media = False
 embed = False
 output = ''
 d_json = False
+dump_format = 'files'
+dump_streams = {}
+dump_lock = threading.Lock()
+database = None
+source = None
+container_format = None
+containers = {}
 g_quiet = False
+verbosity = 0
+progress_bars = False
+log_color = sys.stderr.isatty()
+page_workers = 0
+sub_workers = 0
+sub_pool = None
+sub_page_pool = None
+pool_lock = threading.Lock()
+media_workers = 0
+media_pool = None
+media_jobs = {}
+media_names = {}
+media_store = None
+media_index = {}
+media_checked = set()
+revalidate = 'conditional'
+embed_refs = False
+embed_max = 0
+embed_keys = {}
+embed_spare = {}
+store_links = True
+media_lock = threading.Lock()
+jobs = 1
+no_sub = False
+s_out = False
+update = False
+active_fns = set()
+fn_lock = threading.Lock()
+results_lock = threading.Lock()
+stdout_lock = threading.Lock()
+log_lock = threading.Lock()
+log_local = threading.local()
+stats = {}
+stats_lock = threading.Lock()
+metrics = None
+job_local = threading.local()
+profiler = None
+profilers = []
+timeout = REQ_TIMEOUT
+session = None
+cache = None
+profiles = {}
+resolved = {}
+profile_bodies = {}
+profiles_recorded = {}
+profiles_lock = threading.Lock()
+
+
+def init_session(pool_hosts=POOL_HOSTS, pool_size=POOL_SIZE):
+	# One keep-alive session for the API and every CDN; connections are pooled per host
+	global session
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+
+class RateLimiter:
+	# Token bucket shared by every worker talking to the same host
+	def __init__(self, rate, burst=1):
+		self.rate = rate
+		self.burst = max(burst, 1)
+		self.tokens = self.burst
+		self.stamp = time.monotonic()
+		self.until = 0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			now = time.monotonic()
+			if self.rate > 0:
+				self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+				self.stamp = now
+				# Tokens may go negative, so waiting workers are served in the order they arrived
+				self.tokens -= 1
+				wait = -self.tokens / self.rate if self.tokens < 0 else 0
+			else:
+				wait = 0
+			wait = max(wait, self.until - now)
+		if wait > 0:
+			time.sleep(wait)
+
+	def pause(self, delay):
+		with self.lock:
+			self.until = max(self.until, time.monotonic() + delay)
+
+
+def get_limiter(url):
+	host = parse.urlsplit(url).netloc
+	with limiters_lock:
+		limiter = limiters.get(host)
+		if limiter is None:
+			rate, burst = rates.get(host, (0, 1))
+			limiter = limiters[host] = RateLimiter(rate, burst)
+		return limiter
+
+
+def parse_retry_after(value):
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+	try:
+		return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+	except (TypeError, ValueError):
+		return None
+
+
+def retry_wait(i, url):
+	# Exponential backoff with full jitter before the i-th retry of URL, counted even when there is no wait
+	if metrics is not None:
+		metrics.add('retry', metric_target(url))
+	if backoff > 0:
+		with timed('stage', 'retry_wait'):
+			time.sleep(random.uniform(0, min(backoff_max, backoff * 2 ** (i - 1))))
+
+
+class ResponseCache:
+	# Responses of the remote on disk, evicting the least recently used ones beyond the size cap
+	def __init__(self, path, max_size, refresh=False):
+		self.path = path
+		self.max_size = max_size
+		self.refresh = refresh
+		self.lock = threading.Lock()
+		self.size = 0
+		os.makedirs(path, exist_ok=True)
+		for file in self.entries():
+			self.size += file.stat().st_size
+
+	def entries(self):
+		for d in os.scandir(self.path):
+			if d.is_dir():
+				for file in os.scandir(d.path):
+					if file.is_file() and not file.name.endswith('.tmp'):
+						yield file
+
+	def file(self, endpoint, params):
+		key = endpoint + '?' + parse.urlencode(sorted(params.items()))
+		digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+		return os.path.join(self.path, digest[:2], digest)
+
+	def get(self, endpoint, params):
+		if self.refresh:
+			return None
+		file = self.file(endpoint, params)
+		try:
+			with open(file, 'rb') as f:
+				expires = float(f.readline())
+				if expires < time.time():
+					return None
+				data = f.read()
+			# Reading an entry makes it the most recently used one
+			os.utime(file)
+			return data
+		except (OSError, ValueError):
+			return None
+
+	def put(self, endpoint, params, data, ttl):
+		file = self.file(endpoint, params)
+		tmp = '%s.%d.tmp' % (file, threading.get_ident())
+		try:
+			os.makedirs(os.path.dirname(file), exist_ok=True)
+			try:
+				old = os.path.getsize(file)
+			except OSError:
+				old = 0
+			with open(tmp, 'wb') as f:
+				f.write(b'%f\n' % (time.time() + ttl))
+				f.write(data)
+				new = f.tell()
+			os.replace(tmp, file)
+		except OSError as e:
+			log('\033[33mW: Cannot write cache: %s\033[0m' % e)
+			return
+		with self.lock:
+			self.size += new - old
+			if self.size > self.max_size:
+				self.evict()
+
+	def evict(self):
+		files = sorted(self.entries(), key=lambda file: file.stat().st_mtime)
+		# Leave some room so that eviction does not run on every write once the cap is reached
+		limit = self.max_size * 0.9
+		for file in files:
+			if self.size <= limit:
+				break
+			try:
+				size = file.stat().st_size
+				os.remove(file.path)
+				self.size -= size
+			except OSError:
+				pass
+
+
+def cache_get(endpoint, params):
+	if cache is None:
+		return None
+	data = cache.get(endpoint, params)
+	if data is not None:
+		add_stat('cache_hits')
+	if metrics is not None:
+		metrics.add('cache', endpoint, code='hit' if data is not None else 'miss')
+	return data
+
+
+def cache_put(endpoint, params, data, parsed=None):
+	if cache is None:
+		return
+	ttl = CACHE_TTL_LAST
+	if endpoint == '/user_profile':
+		ttl = CACHE_TTL_USER
+	else:
+		# Only the last page of a thread or of a floor's subposts is still expected to grow; the first one tells
+		# how many pages there are, so it expires as soon as the last one
+		try:
+			if parsed is None:
+				parsed = json_loads(data)
+			page = parsed['page']
+			if 1 < int(page['current_page']) < int(page['total_page']):
+				ttl = CACHE_TTL_PAGE
+		except (KeyError, TypeError, ValueError):
+			pass
+	cache.put(endpoint, params, data, ttl)
+
+
+class DataURICache:
+	# Encoded media kept for repeated embeds, dropping the least recently used beyond the byte budget
+	def __init__(self, budget):
+		self.budget = budget
+		self.size = 0
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, src):
+		with self.lock:
+			uri = self.items.get(src)
+			if uri is not None:
+				self.items.move_to_end(src)
+			return uri
+
+	def put(self, src, uri):
+		if len(uri) > self.budget:
+			return
+		with self.lock:
+			if src in self.items:
+				return
+			self.items[src] = uri
+			self.size += len(uri)
+			while self.size > self.budget:
+				self.size -= len(self.items.popitem(last=False)[1])
+
+
+embed_cache = DataURICache(EMBED_CACHE_SIZE * 1048576)
+
+
+def add_stat(key, n=1):
+	with stats_lock:
+		stats[key] = stats.get(key, 0) + n
+
+
+class Metrics:
+	# Counts, time and bytes of requests and stages, for the whole run and for every thread fetched
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.start = time.time()
+		self.run = {}
+		self.threads = {}
+
+	def add(self, kind, name, seconds=0.0, size=0, code=None, count=1):
+		thread = getattr(job_local, 'thread', None)
+		with self.lock:
+			tables = [self.run] if thread is None else [self.run, self.threads.setdefault(thread, {})]
+			for table in tables:
+				entry = table.setdefault(kind, {}).get(name)
+				if entry is None:
+					entry = table[kind][name] = {'count': 0, 'seconds': 0.0, 'bytes': 0, 'codes': {}}
+				entry['count'] += count
+				entry['seconds'] += seconds
+				entry['bytes'] += size
+				if code is not None:
+					entry['codes'][str(code)] = entry['codes'].get(str(code), 0) + 1
+
+	def write_json(self, file):
+		with self.lock:
+			text = json.dumps({'seconds': time.time() - self.start, 'run': self.run, 'threads': self.threads}, indent=1)
+		with open(file, 'w') as f:
+			f.write(text)
+
+	def write_prometheus(self, file):
+		# In the text format of the textfile collector, replaced at once so that it is never read half written
+		lines = []
+
+		def family(name, kind, text, samples):
+			lines.append('# HELP tieba_fetcher_%s %s' % (name, text))
+			lines.append('# TYPE tieba_fetcher_%s %s' % (name, kind))
+			for labels, value in samples:
+				labels = ','.join('%s="%s"' % (
+					k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+				lines.append('tieba_fetcher_%s%s %s' % (name, '{%s}' % labels if len(labels) > 0 else '', repr(float(value))))
+
+		with self.lock:
+			run = self.run
+			sent = run.get('request', {})
+			family('requests_total', 'counter', 'Requests sent, by endpoint of the remote or host, and status', [
+				((('target', t), ('code', c)), n) for t, e in sorted(sent.items()) for c, n in sorted(e['codes'].items())])
+			family('request_seconds_total', 'counter', 'Time spent in requests, including reading their bodies', [
+				((('target', t),), e['seconds']) for t, e in sorted(sent.items())])
+			family('request_bytes_total', 'counter', 'Bytes received', [
+				((('target', t),), e['bytes']) for t, e in sorted(sent.items())])
+			family('retries_total', 'counter', 'Requests sent again after a failure, by endpoint of the remote or host', [
+				((('target', t),), e['count']) for t, e in sorted(run.get('retry', {}).items())])
+			family('stage_seconds_total', 'counter', 'Time spent in a stage, leaving out requests and stages within it', [
+				((('stage', t),), e['seconds']) for t, e in sorted(run.get('stage', {}).items())])
+			family('stage_calls_total', 'counter', 'Times a stage was entered', [
+				((('stage', t),), e['count']) for t, e in sorted(run.get('stage', {}).items())])
+			family('cache_lookups_total', 'counter', 'Lookups in the response cache, by endpoint and result', [
+				((('endpoint', t), ('result', c)), n) for t, e in sorted(run.get('cache', {}).items())
+				for c, n in sorted(e['codes'].items())])
+			family('threads_total', 'counter', 'Threads fetched, by result', [
+				((('result', t),), e['count']) for t, e in sorted(run.get('thread', {}).items())])
+			family('run_seconds', 'gauge', 'Duration of the run', [((), time.time() - self.start)])
+			family('last_run_timestamp_seconds', 'gauge', 'When the run ended', [((), time.time())])
+		tmp = '%s.tmp' % file
+		with open(tmp, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.replace(tmp, file)
+
+
+@contextmanager
+def timed(kind, name):
+	# Times a request or stage without the ones nested in it; the yielded dict takes further fields to record
+	fields = {}
+	if metrics is None:
+		yield fields
+		return
+	stack = getattr(job_local, 'stack', None)
+	if stack is None:
+		stack = job_local.stack = []
+	stack.append(0.0)
+	start = time.perf_counter()
+	try:
+		yield fields
+	finally:
+		elapsed = time.perf_counter() - start
+		nested = stack.pop()
+		if len(stack) > 0:
+			stack[-1] += elapsed
+		metrics.add(kind, name, seconds=elapsed - nested, **fields)
+
+
+def metric_target(url):
+	# Requests to the remote are told apart by endpoint, the others by host
+	if url.startswith(remote):
+		return url[len(remote):] or '/'
+	return parse.urlsplit(url).netloc
+
+
+def in_context(func):
+	# Tasks handed to pools are accounted to the thread being fetched, report to its progress, and are profiled if asked
+	thread = getattr(job_local, 'thread', None)
+	progress = getattr(job_local, 'progress', None)
+	prefix = getattr(log_local, 'prefix', '')
+
+	def run(*args, **kwargs):
+		job_local.thread = thread
+		job_local.progress = progress
+		log_local.prefix = prefix
+		worker = worker_profiler()
+		if worker is not None:
+			try:
+				worker.enable()
+			except ValueError:
+				# Profilers that follow every thread at once refuse a second one
+				worker = None
+		try:
+			return func(*args, **kwargs)
+		finally:
+			if worker is not None:
+				worker.disable()
+			job_local.thread = None
+			job_local.progress = None
+			log_local.prefix = ''
+	return run
+
+
+def worker_profiler():
+	# cProfile only follows the thread it is enabled in, so every worker gets its own, merged in the end
+	if profiler is None or threading.current_thread() is threading.main_thread():
+		return None
+	worker = getattr(job_local, 'profiler', None)
+	if worker is None:
+		worker = job_local.profiler = cProfile.Profile()
+		with stats_lock:
+			profilers.append(worker)
+	return worker
+
+
+def get_media_pool():
+	global media_pool
+	with pool_lock:
+		if media_pool is None:
+			media_pool = ThreadPoolExecutor(max_workers=media_workers)
+		return media_pool
+
+
+def get_sub_pool():
+	global sub_pool
+	with pool_lock:
+		if sub_pool is None:
+			sub_pool = ThreadPoolExecutor(max_workers=sub_workers)
+		return sub_pool
+
+
+def get_sub_page_pool():
+	global sub_page_pool
+	with pool_lock:
+		if sub_page_pool is None:
+			sub_page_pool = ThreadPoolExecutor(max_workers=sub_workers)
+		return sub_page_pool
+
+
+def log(*args, end='\n'):
+	# Partial lines are kept per thread and written out whole, so concurrent jobs never interleave
+	text = getattr(log_local, 'buf', '') + ' '.join(str(a) for a in args) + end
+	if not text.endswith('\n'):
+		log_local.buf = text
+		return
+	log_local.buf = ''
+	prefix = getattr(log_local, 'prefix', '')
+	if len(prefix) > 0:
+		text = ''.join(prefix + line for line in text.splitlines(True))
+	if not log_color:
+		# Colors only mean something to a terminal, logs collected elsewhere get the plain text
+		text = ANSI_ESCAPE.sub('', text)
+	with log_lock:
+		if progress_bars:
+			# Moves the bar below the message instead of writing over it
+			tqdm.write(text, file=sys.stderr, end='')
+		else:
+			sys.stderr.write(text)
+			sys.stderr.flush()
+
+
+class Progress:
+	# What has been fetched of a thread, shown as a single bar on a terminal or a status line every few seconds
+	def __init__(self, thread):
+		self.thread = thread
+		self.lock = threading.Lock()
+		self.started = time.monotonic()
+		self.shown = self.started
+		self.pages = 0
+		self.total = 0
+		self.floors = 0
+		self.subposts = 0
+		self.media = 0
+		self.media_bytes = 0
+		self.bar = None
+		if progress_bars:
+			self.bar = tqdm(
+				desc='    %s' % thread, unit='page', leave=False, mininterval=PROGRESS_INTERVAL, file=sys.stderr)
+
+	def add(self, pages=0, floors=0, subposts=0, media=0, media_bytes=0, total=None):
+		with self.lock:
+			self.pages += pages
+			self.floors += floors
+			self.subposts += subposts
+			self.media += media
+			self.media_bytes += media_bytes
+			if total is not None and total != self.total:
+				self.total = total
+				if self.bar is not None:
+					self.bar.total = total
+					self.bar.refresh()
+			if self.bar is not None:
+				# The bar redraws itself at most every PROGRESS_INTERVAL seconds
+				self.bar.set_postfix_str(self.counts(), refresh=False)
+				self.bar.update(pages)
+				return
+			if g_quiet:
+				return
+			now = time.monotonic()
+			if now - self.shown < PROGRESS_INTERVAL_PLAIN:
+				return
+			self.shown = now
+			text = self.status()
+		log('    %s' % text)
+
+	def counts(self):
+		return '%d floors, %d subposts, %d media files (%s)' % (
+			self.floors, self.subposts, self.media, format_size(self.media_bytes))
+
+	def status(self):
+		text = '%d/%d pages, %s' % (self.pages, max(self.total, self.pages), self.counts())
+		if 0 < self.pages < self.total:
+			eta = (time.monotonic() - self.started) / self.pages * (self.total - self.pages)
+			text += ', ETA %d:%02d' % divmod(int(eta), 60)
+		return text
+
+	def close(self):
+		with self.lock:
+			if self.bar is not None:
+				self.bar.close()
+				self.bar = None
+		return time.monotonic() - self.started
+
+
+def progress_add(**counts):
+	# Counts towards the progress of the thread being fetched, if any
+	progress = getattr(job_local, 'progress', None)
+	if progress is not None:
+		progress.add(**counts)
+
+
+def format_size(n):
+	for unit in ('B', 'KiB', 'MiB'):
+		if n < 1024:
+			return '%d %s' % (n, unit) if unit == 'B' else '%.1f %s' % (n, unit)
+		n /= 1024
+	return '%.1f GiB' % n
+
+
+def http_get(url, params=None, stream=False, headers=None):
+	return http_request('GET', url, params=params, stream=stream, headers=headers)
+
+
+def http_head(url):
+	return http_request('HEAD', url, allow_redirects=True)
+
+
+def http_request(method, url, **kwargs):
+	if session is None:
+		init_session()
+	limiter = get_limiter(url)
+	with timed('stage', 'rate_limit'):
+		limiter.acquire()
+	with timed('request', metric_target(url)) as m:
+		req = session.request(method, url, timeout=timeout, **kwargs)
+		m['code'] = req.status_code
+		if not kwargs.get('stream', False):
+			m['size'] = len(req.content)
+	if req.status_code in (429, 503):
+		# Hold back every worker on this host for as long as the server asked
+		delay = parse_retry_after(req.headers.get('Retry-After', ''))
+		limiter.pause(delay if delay is not None else backoff)
+	return req
 
 
 def dump_json(data, fn, cat, xid, pid='', page=1):
 	try:
 		if len(fn) == 0:
 			return
+		if dump_format != 'files':
+			stream = dump_stream(fn)
+			with timed('stage', 'dump'):
+				stream.add(DUMP_KINDS[cat], xid, pid, page, data)
+			return
 		dirname = '%s.html_jsons' % fn
 		pathname = os.path.join(output, dirname)
 		os.makedirs(pathname, exist_ok=True)
@@ -47,502 +722,1878 @@ def dump_json(data, fn, cat, xid, pid='', page=1):
 		if filename is None:
 			raise Exception('Invalid data category')
 		file = os.path.join(pathname, filename)
-		with open(file, 'wb') as f:
+		with open(file, 'wb') as f, timed('stage', 'dump'):
 			f.write(data)
 	except Exception as e:
-		print('\033[1;31mE: %s\033[0m' % e, file=sys.stderr)
+		log('\033[1;31mE: %s\033[0m' % e)
+
+
+class DumpStream:
+	# Responses of a thread appended to one NDJSON stream, each record compressed on its own to be read alone later
+	def __init__(self, file):
+		self.file = file
+		self.lock = threading.Lock()
+		self.encode = None
+		if file.endswith('.gz'):
+			self.encode = gzip_member
+		elif file.endswith('.zst'):
+			self.encode = zstandard.ZstdCompressor().compress
+		self.f = open(file, 'ab')
+		# One line of [kind, id, pid, page, offset, length] per record, appended right after the record itself
+		self.index = open('%s.idx' % file, 'a')
+
+	def add(self, kind, xid, pid, page, data):
+		# Newlines in a body can only be whitespace between tokens, the rest of it is copied as is
+		record = b'{"kind": "%s", "id": %s, "pid": %s, "page": %d, "data": %s}\n' % (
+			kind.encode('ascii'), json.dumps(str(xid)).encode('utf-8'), json.dumps(str(pid)).encode('utf-8'), page,
+			data.replace(b'\r', b' ').replace(b'\n', b' '))
+		if self.encode is not None:
+			record = self.encode(record)
+		with self.lock:
+			offset = self.f.tell()
+			self.f.write(record)
+			self.f.flush()
+			self.index.write('%s\n' % json.dumps([kind, str(xid), str(pid), page, offset, len(record)]))
+			self.index.flush()
+
+	def close(self):
+		with self.lock:
+			self.f.close()
+			self.index.close()
+
+
+class DumpReader:
+	# Reads any record of a dump stream through its index, decompressing that record only
+	def __init__(self, file):
+		self.file = file
+		self.lock = threading.Lock()
+		self.decode = None
+		if file.endswith('.gz'):
+			self.decode = lambda record: zlib.decompress(record, 31)
+		elif file.endswith('.zst'):
+			if zstandard is None:
+				raise Exception('Install <zstandard> to read %s' % file)
+			self.decode = zstandard.ZstdDecompressor().decompress
+		self.records = {}
+		with open('%s.idx' % file, 'rb') as f:
+			for line in f:
+				try:
+					kind, xid, pid, page, offset, length = json_loads(line)
+				except ValueError:
+					# Cut short by an interrupted run
+					continue
+				# Responses dumped again by later runs take the place of earlier ones
+				self.records[(kind, xid, pid, page)] = (offset, length)
+		self.f = open(file, 'rb')
+
+	def response(self, kind, xid, pid='', page=1):
+		# The response as received, which DumpStream writes last in a record
+		entry = self.records.get((kind, str(xid), str(pid), page))
+		if entry is None:
+			return None
+		with self.lock:
+			self.f.seek(entry[0])
+			record = self.f.read(entry[1])
+		if self.decode is not None:
+			record = self.decode(record)
+		return record[record.index(b'"data": ') + 8:-2]
+
+	def get(self, kind, xid, pid='', page=1):
+		data = self.response(kind, xid, pid=pid, page=page)
+		return None if data is None else json_loads(data)
+
+	def threads(self):
+		return [xid for kind, xid, pid, page in self.records if kind == 'thread' and page == 1]
+
+	def page(self, tid, page=1):
+		return self.get('thread', tid, page=page)
+
+	def subposts(self, tid, pid, page=1):
+		return self.get('subpost', tid, pid=pid, page=page)
+
+	def user(self, uid):
+		return self.get('user', uid)
+
+	def keys(self):
+		return list(self.records)
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class DumpFiles:
+	# Reads the dumps of a thread written one file per response
+	def __init__(self, path):
+		self.path = path
+
+	def response(self, kind, xid, pid='', page=1):
+		filename = 'thread_%s_%d.json' % (xid, page) if kind == 'thread' else 'subpost_%s_%s_%d.json' % (
+			xid, pid, page) if kind == 'subpost' else 'user_%s.json' % xid
+		try:
+			with open(os.path.join(self.path, filename), 'rb') as f:
+				return f.read()
+		except OSError:
+			return None
+
+	def threads(self):
+		return [name[7:-7] for name in os.listdir(self.path) if name.startswith('thread_') and name.endswith('_1.json')]
+
+	def close(self):
+		pass
+
+
+def open_dump(path):
+	return DumpFiles(path) if os.path.isdir(path) else DumpReader(path)
+
+
+def find_dumps(paths):
+	# Dumps named in PATHS and those found in directories among them
+	for path in paths:
+		# A trailing separator would hide the suffix, and the directory of the dump with it
+		path = os.path.normpath(path)
+		found = 0
+		if path.endswith('.html_jsons') or path.endswith(DUMP_STREAMS):
+			found += 1
+			yield path
+		elif os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if name.endswith('.html_jsons') or name.endswith(DUMP_STREAMS):
+					found += 1
+					yield os.path.join(path, name)
+		if found == 0:
+			log('\033[33mW: No dumps found in %s\033[0m' % path)
+
+
+def gzip_member(data):
+	# A complete gzip member, a file of them concatenated is still a valid gzip file
+	c = zlib.compressobj(6, zlib.DEFLATED, 31)
+	return c.compress(data) + c.flush()
+
+
+def dump_stream(fn):
+	with dump_lock:
+		stream = dump_streams.get(fn)
+		if stream is None:
+			stream = dump_streams[fn] = DumpStream(os.path.join(output, '%s.%s' % (fn, dump_format)))
+		return stream
+
+
+def close_dump(fn):
+	with dump_lock:
+		stream = dump_streams.pop(fn, None)
+	if stream is not None:
+		stream.close()
+
 
+class ThreadDatabase:
+	# Threads, posts, subposts, users and media in SQLite; rows are queued and committed in batches by a writer thread
+	def __init__(self, file, blobs=False):
+		self.file = file
+		self.blobs = blobs
+		self.local = threading.local()
+		self.queue = queue.Queue()
+		db = self.connect()
+		db.executescript(DB_SCHEMA)
+		db.commit()
+		self.writer = threading.Thread(target=self.write_batches, daemon=True)
+		self.writer.start()
 
-def res2b64(src, fallback='application/octet-stream', quiet=False, size=0):
+	def connect(self):
+		# Connections cannot be shared between threads, each one opens its own
+		db = getattr(self.local, 'db', None)
+		if db is None:
+			db = self.local.db = sqlite3.connect(self.file, timeout=60)
+			# Readers never wait for the writer, which only syncs at checkpoints
+			db.execute('PRAGMA journal_mode = WAL')
+			db.execute('PRAGMA synchronous = NORMAL')
+		return db
+
+	def write_batches(self):
+		db = self.connect()
+		while True:
+			batch = [self.queue.get()]
+			while len(batch) < DB_BATCH:
+				try:
+					batch.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				with db:
+					for item in batch:
+						if item is not None:
+							db.executemany(DB_UPSERT[item[0]], item[1])
+			except sqlite3.Error as e:
+				log('\033[1;31mE: Cannot write to %s: %s\033[0m' % (self.file, e))
+			if None in batch:
+				break
+
+	def put(self, table, rows):
+		if len(rows) > 0:
+			self.queue.put((table, rows))
+
+	def add_response(self, kind, xid, pid, page, data, parsed):
+		self.put('responses', [(kind, str(xid), str(pid), page, data, time.time())])
+		try:
+			if kind == 'thread':
+				self.add_page(str(xid), parsed)
+			elif kind == 'subpost':
+				self.put('subposts', [subpost_row(str(xid), str(pid), sp) for sp in parsed['subpost_list']])
+			elif kind == 'user':
+				self.put('users', [[str(xid)] + user_entry(parsed['user'])])
+		except (KeyError, TypeError, ValueError):
+			pass
+
+	def add_page(self, tid, data):
+		thread = data.get('thread', {})
+		title = thread.get('title', thread.get('thread_info', {}).get('title'))
+		forum = data.get('forum', {}).get('name')
+		try:
+			pages = int(data['page']['total_page'])
+		except (KeyError, TypeError, ValueError):
+			pages = None
+		self.put('threads', [(tid, title, forum, pages, time.time())])
+		posts = []
+		subposts = []
+		for post in data.get('post_list', []):
+			try:
+				posts.append((
+					post['id'], tid, int(post['floor']), post.get('author_id'), int(post.get('time', 0)), reply_count(post),
+					json.dumps(post.get('content'), ensure_ascii=False)))
+				embedded = post.get('sub_post_list') or {}
+				for sp in embedded.get('sub_post_list') or []:
+					subposts.append(subpost_row(tid, post['id'], sp))
+			except (KeyError, TypeError, ValueError):
+				pass
+		self.put('posts', posts)
+		self.put('subposts', subposts)
+		users = []
+		for user in data.get('user_list', []):
+			try:
+				users.append([str(user['id'])] + user_entry(user))
+			except (KeyError, TypeError):
+				pass
+		self.put('users', users)
+
+	def add_media(self, tid, src, cat, file):
+		self.put('media', [(str(tid), src, cat, file)])
+
+	def add_blob(self, src, file):
+		if self.has_blob(src):
+			return
+		try:
+			with open(file, 'rb') as f:
+				self.put('blobs', [(src, f.read())])
+		except OSError as e:
+			log('\033[1;31mE: %s\033[0m' % e)
+
+	def has_blob(self, src):
+		return self.connect().execute('SELECT 1 FROM blobs WHERE src = ?', (src,)).fetchone() is not None
+
+	def restore(self, src, file):
+		# Writes a media file kept in the database back
+		row = self.connect().execute('SELECT data FROM blobs WHERE src = ?', (src,)).fetchone()
+		if row is None:
+			return False
+		tmp = '%s.%d.tmp' % (file, threading.get_ident())
+		with open(tmp, 'wb') as f:
+			f.write(row[0])
+		os.replace(tmp, file)
+		return True
+
+	def response(self, kind, xid, pid='', page=1):
+		row = self.connect().execute(
+			'SELECT data FROM responses WHERE kind = ? AND id = ? AND pid = ? AND page = ?',
+			(kind, str(xid), str(pid), page)).fetchone()
+		return None if row is None else bytes(row[0])
+
+	def close(self):
+		# Waits until everything queued is committed
+		self.queue.put(None)
+		self.writer.join()
+
+
+class ThreadContainer:
+	# The page of a thread and its media files in one zip or WARC file, entries are added as downloads complete
+	def __init__(self, file, kind):
+		self.file = file
+		self.kind = kind
+		self.lock = threading.Lock()
+		self.names = set()
+		if kind == 'zip':
+			self.zip = zipfile.ZipFile('%s.part' % file, 'w')
+		else:
+			self.f = open('%s.part' % file, 'wb')
+			info = b'software: tieba-thread-fetcher\r\nformat: WARC File Format 1.1\r\n'
+			self.write_record('warcinfo', None, 'application/warc-fields', [info], len(info))
+
+	def fetch(self, src, name):
+		with self.lock:
+			if name in self.names:
+				return True
+		fd, tmp = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			response = {}
+			if source is not None:
+				# Only media kept in the database, there is no response to record but the content
+				if database is None or not database.restore(src, tmp):
+					return False
+			elif not download(src, tmp, response=response):
+				return False
+			self.add(name, tmp, response)
+			return True
+		except (OSError, zipfile.BadZipFile) as e:
+			log('\033[1;31mE: %s\033[0m' % e)
+			return False
+		finally:
+			os.remove(tmp)
+			if os.path.isfile('%s.part' % tmp):
+				os.remove('%s.part' % tmp)
+
+	def add(self, name, file, response):
+		size = os.path.getsize(file)
+		with open(file, 'rb') as f, self.lock:
+			if name in self.names:
+				return
+			self.names.add(name)
+			if self.kind == 'zip':
+				# Media are compressed already, they are stored as they are
+				info = zipfile.ZipInfo(name, time.localtime()[:6])
+				with self.zip.open(info, 'w', force_zip64=size > 0x7fffffff) as entry:
+					shutil.copyfileobj(f, entry, BUF_SIZE * 16)
+				return
+			head = 'HTTP/1.1 %d %s\r\n' % (response.get('status', 200), response.get('reason', 'OK'))
+			for key, value in response.get('headers', [('Content-Type', mimetypes.guess_type(name.split('?')[0])[0])]):
+				# The body is kept as received, neither chunked nor compressed, at its own length
+				if value is not None and key.lower() not in ('content-length', 'transfer-encoding', 'content-encoding'):
+					head += '%s: %s\r\n' % (key, value)
+			head = (head + 'Content-Length: %d\r\n\r\n' % size).encode('latin-1', 'replace')
+			self.write_record(
+				'response', name, 'application/http; msgtype=response',
+				itertools.chain([head], iter(lambda: f.read(BUF_SIZE * 16), b'')), len(head) + size)
+
+	def add_page(self, f, uri, name):
+		# The page read from F, a binary file
+		with self.lock:
+			if self.kind == 'zip':
+				info = zipfile.ZipInfo(name, time.localtime()[:6])
+				info.compress_type = zipfile.ZIP_DEFLATED
+				with self.zip.open(info, 'w') as entry:
+					shutil.copyfileobj(f, entry, BUF_SIZE * 16)
+				return
+			size = f.seek(0, os.SEEK_END)
+			f.seek(0)
+			self.write_record(
+				'resource', uri, 'text/html; charset=utf-8', iter(lambda: f.read(BUF_SIZE * 16), b''), size)
+
+	def write_record(self, kind, uri, content_type, chunks, length):
+		# Each record is a gzip member of its own, as usual for WARC files
+		head = 'WARC/1.1\r\nWARC-Type: %s\r\nWARC-Record-ID: <urn:uuid:%s>\r\nWARC-Date: %s\r\n' % (
+			kind, uuid.uuid4(), time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+		if uri is not None:
+			head += 'WARC-Target-URI: %s\r\n' % uri
+		head += 'Content-Type: %s\r\nContent-Length: %d\r\n\r\n' % (content_type, length)
+		c = zlib.compressobj(6, zlib.DEFLATED, 31)
+		self.f.write(c.compress(head.encode('utf-8')))
+		for cb in chunks:
+			self.f.write(c.compress(cb))
+		self.f.write(c.compress(b'\r\n\r\n'))
+		self.f.write(c.flush())
+
+	def close(self):
+		if self.kind == 'zip':
+			self.zip.close()
+		else:
+			self.f.close()
+		os.replace('%s.part' % self.file, self.file)
+
+	def abort(self):
+		try:
+			if self.kind == 'zip':
+				self.zip.close()
+			else:
+				self.f.close()
+		except (OSError, ValueError):
+			pass
+		log('\033[33mW: Partial archive left at %s.part\033[0m' % self.file)
+
+
+def container_media(src, fn, cat):
+	# Media go straight into the container of the thread; zip keeps the layout of local files, WARC the addresses
+	with media_lock:
+		container = containers.get(fn)
+	if container is None:
+		return src
+	if container.kind == 'zip':
+		name = '%s.html_files/%s/%s' % (fn, cat, media_name(fn, cat, src))
+		ref = parse.quote(name)
+	else:
+		name = ref = src
+	if media_workers > 0:
+		with media_lock:
+			jobs = media_jobs.setdefault(fn, {})
+			if name not in jobs:
+				jobs[name] = (src, get_media_pool().submit(in_context(container.fetch), src, name))
+		return ref
+	return ref if container.fetch(src, name) else src
+
+
+def subpost_row(tid, pid, subpost):
+	author = subpost.get('author_id')
+	if author is None and 'author' in subpost:
+		author = subpost['author'].get('id')
+	return (
+		subpost['id'], pid, tid, author, int(subpost.get('time', 0)),
+		json.dumps(subpost.get('content'), ensure_ascii=False))
+
+
+def record_response(data, parsed, fn, cat, xid, pid='', page=1):
+	# Keeps a response as received, in the dumps and the database as asked
+	if d_json:
+		dump_json(data, fn, cat, xid, pid=pid, page=page)
+	if database is not None and source is None:
+		database.add_response(DUMP_KINDS[cat], xid, pid, page, data, parsed)
+
+
+def embed_media(out, src, fn, cat='', fallback='application/octet-stream', size=0):
+	# Writes a data URI, encoding the media in aligned chunks straight into the page
 	if src[:2] == '//':
 		src = 'http:' + src
-	buf = b''
+	uri = embed_cache.get(src)
+	if uri is not None:
+		add_stat('embed_hits')
+		out(uri)
+		return
+	if 0 < embed_max < size:
+		out(res2local(src, fn, cat=cat))
+		return
+	fd, tmp = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		validators = {}
+		response = {}
+		if not download(src, tmp, validators=validators, response=response):
+			out(src)
+			return
+		length = os.path.getsize(tmp)
+		if 0 < embed_max < length:
+			# Too large to embed, kept as a local file or a link instead; its download takes the file already received
+			spare = '%s.spare' % tmp
+			os.replace(tmp, spare)
+			with media_lock:
+				embed_spare[src] = (fn, spare, validators, response)
+			out(res2local(src, fn, cat=cat))
+			return
+		mt = mimetypes.guess_type(src.split('?')[0])[0]
+		if mt is None:
+			mt = fallback
+		with open(tmp, 'rb') as f:
+			if length <= EMBED_INLINE:
+				uri = 'data:%s;base64,%s' % (mt, base64.b64encode(f.read()).decode('ascii'))
+				embed_cache.put(src, uri)
+				out(uri)
+			else:
+				out('data:%s;base64,' % mt)
+				for cb in iter(lambda: f.read(EMBED_CHUNK), b''):
+					out(base64.b64encode(cb).decode('ascii'))
+	finally:
+		if os.path.isfile(tmp):
+			os.remove(tmp)
+		if os.path.isfile('%s.part' % tmp):
+			os.remove('%s.part' % tmp)
+
+
+def write_src(out, attr, src, fn, cat, fallback, overwrite=True, size=0, refs=False):
+	# Writes an attribute referring to a media file; with --embed-refs repeated embeds point at the first copy
+	if no_media:
+		out(' %s="%s"' % (attr, src))
+		return
+	if not embed:
+		out(' %s="%s"' % (attr, res2local(src, fn, cat=cat, overwrite=overwrite)))
+		return
+	if refs and embed_refs and len(fn) > 0:
+		key = hashlib.sha1(src.encode('utf-8')).hexdigest()[:16]
+		with media_lock:
+			keys = embed_keys.setdefault(fn, set())
+			seen = key in keys
+			keys.add(key)
+		if seen:
+			add_stat('embed_refs')
+			out(' %s="" data-embed-ref="%s"' % (attr, key))
+			return
+		out(' data-embed-id="%s"' % key)
+	out(' %s="' % attr)
+	embed_media(out, src, fn, cat=cat, fallback=fallback, size=size)
+	out('"')
+
+
+def res2local(src, fn,  cat='', overwrite=True):
+	if src[:2] == '//':
+		src = 'http:' + src
+	if len(fn) == 0:
+		return src
+	if container_format is not None:
+		return container_media(src, fn, cat)
+	dirname = '%s.html_files' % fn
+	if media_store is not None and not store_links:
+		# The store cannot be linked into the output, so pages refer to it directly
+		file = store_file(src)
+		ref = parse.quote(os.path.relpath(file, output if len(output) > 0 else '.'))
+	else:
+		pathname = os.path.join(output, dirname, cat)
+		os.makedirs(pathname, exist_ok=True)
+		filename = media_name(fn, cat, src)
+		file = os.path.join(pathname, filename)
+		ref = parse.quote(os.path.join(dirname, cat, filename))
+	if database is not None and source is None:
+		database.add_media(getattr(job_local, 'thread', ''), src, cat, ref)
+	if not overwrite and os.path.isfile(file):
+		return ref
+	if media_workers > 0:
+		# Downloaded in background, the path is referenced right away and the thread joins before finalizing
+		with media_lock:
+			jobs = media_jobs.setdefault(fn, {})
+			if file not in jobs:
+				jobs[file] = (src, get_media_pool().submit(in_context(fetch_media), src, file))
+		return ref
+	fetch_media(src, file)
+	return ref if os.path.isfile(file) else src
+
+
+def media_name(fn, cat, src):
+	# Different sources sharing a basename within a thread get told apart by a hash of the source
+	filename = os.path.basename(src.split('?')[0])
+	with media_lock:
+		owner = media_names.setdefault(fn, {}).setdefault((cat, filename), src)
+	if owner != src:
+		stem, ext = os.path.splitext(filename)
+		filename = '%s_%s%s' % (stem, hashlib.sha1(src.encode('utf-8')).hexdigest()[:8], ext)
+	return filename
+
+
+def store_file(src):
+	# Every source has one entry in the store, a hard link to the object holding its content
+	digest = hashlib.sha1(src.encode('utf-8')).hexdigest()
+	ext = os.path.splitext(src.split('?')[0])[1]
+	return os.path.join(media_store, 'urls', digest[:2], digest + ext)
+
+
+def fetch_media(src, file):
+	if source is not None:
+		# Only what earlier runs left behind or kept in the database
+		return os.path.isfile(file) or database is not None and database.restore(src, file)
+	ok = fetch_remote(src, file)
+	if ok and database is not None and database.blobs:
+		database.add_blob(src, file)
+	return ok
+
+
+def fetch_remote(src, file):
+	if media_store is None:
+		return fetch_local(src, file)
+	entry = store_file(src)
+	if os.path.isfile(entry):
+		add_stat('store_hits')
+	elif not store_media(src, entry):
+		return False
+	if file == entry:
+		return True
+	try:
+		if os.path.isfile(file) and os.path.samefile(entry, file):
+			# Linked by an earlier reference, renaming onto the same file would leave the temporary one behind
+			return True
+	except OSError:
+		pass
+	tmp = '%s.%d.tmp' % (file, threading.get_ident())
+	try:
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+		try:
+			os.link(entry, tmp)
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+			shutil.copyfile(entry, tmp)
+		os.replace(tmp, file)
+	except OSError as e:
+		log('\033[1;31mE: %s\033[0m' % e)
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+		return False
+	return True
+
+
+def media_key(file):
+	return os.path.relpath(file, output if len(output) > 0 else '.')
+
+
+def fetch_local(src, file):
+	# A media file already there is kept if it still matches the server, as far as the revalidation mode asks
+	key = media_key(file)
+	with media_lock:
+		if key in media_checked:
+			# Already downloaded or checked in this run
+			return True
+		known = media_index.get(key)
+	check = None
+	if revalidate != 'always' and os.path.isfile(file):
+		length = os.path.getsize(file)
+		if known is not None and known.get('length', length) != length:
+			# Cut short by an earlier run, downloaded again as a whole
+			known = None
+		elif revalidate == 'trust' or revalidate == 'head' and head_fresh(src, length, known):
+			add_stat('media_kept')
+			with media_lock:
+				media_checked.add(key)
+			return True
+		elif revalidate == 'conditional':
+			if known is not None:
+				check = known
+			else:
+				# Files from runs before the index existed are checked against their modification time
+				check = {'last_modified': email.utils.formatdate(os.path.getmtime(file), usegmt=True)}
+	validators = {}
+	if not download(src, file, check=check, validators=validators):
+		return False
+	with media_lock:
+		media_checked.add(key)
+		if len(validators) > 0:
+			media_index[key] = validators
+	return True
+
+
+def head_fresh(src, length, known):
+	try:
+		req = http_head(src)
+	except requests.RequestException:
+		return False
+	if req.status_code != 200:
+		return False
+	if known is not None:
+		for field, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+			if field in known and header in req.headers:
+				return req.headers[header] == known[field]
+	try:
+		return int(req.headers['Content-Length']) == length
+	except (KeyError, ValueError):
+		return False
+
+
+def load_media_index(file):
+	try:
+		with open(file, 'rb') as f:
+			saved = json_loads(f.read())
+	except (OSError, ValueError):
+		return
+	with media_lock:
+		media_index.update(saved)
+
+
+def save_media_index(file):
+	with media_lock:
+		saved = dict(media_index)
+	tmp = '%s.tmp' % file
+	try:
+		with open(tmp, 'w') as f:
+			json.dump(saved, f)
+		os.replace(tmp, file)
+	except OSError as e:
+		log('\033[33mW: Cannot save media index: %s\033[0m' % e)
+
+
+def store_media(src, entry):
+	tmp = os.path.join(media_store, 'tmp', '%s.%d' % (os.path.basename(entry), threading.get_ident()))
+	os.makedirs(os.path.dirname(tmp), exist_ok=True)
+	if not download(src, tmp):
+		# Names of temporary files differ between runs, so there is nothing to resume later
+		if os.path.isfile('%s.part' % tmp):
+			os.remove('%s.part' % tmp)
+		return False
+	try:
+		h = hashlib.sha256()
+		with open(tmp, 'rb') as f:
+			for cb in iter(lambda: f.read(BUF_SIZE * 16), b''):
+				h.update(cb)
+		digest = h.hexdigest()
+		obj = os.path.join(media_store, 'objects', digest[:2], digest + os.path.splitext(entry)[1])
+		os.makedirs(os.path.dirname(obj), exist_ok=True)
+		if os.path.isfile(obj):
+			# Same content under another source, only one copy is kept
+			add_stat('store_dedup')
+			os.remove(tmp)
+		else:
+			os.replace(tmp, obj)
+		os.makedirs(os.path.dirname(entry), exist_ok=True)
+		try:
+			os.link(obj, entry)
+		except FileExistsError:
+			pass
+		except OSError:
+			shutil.copyfile(obj, entry)
+		return True
+	except OSError as e:
+		log('\033[1;31mE: %s\033[0m' % e)
+		return False
+
+
+def download(src, file, check=None, validators=None, response=None):
+	# With CHECK, the validators of FILE, it is only downloaded if changed on the server; VALIDATORS receives the new ones
+	# RESPONSE receives the status line and headers of the response the file came from
+	# FILE only appears once complete, what was received so far stays in FILE.part and is resumed by later tries or runs
+	if source is not None:
+		# Never leaves the machine when rendering from what earlier runs kept
+		return False
+	with media_lock:
+		spare = embed_spare.pop(src, None)
+	if spare is not None:
+		# Received already while trying to embed it
+		try:
+			shutil.move(spare[1], file)
+			if os.path.isfile('%s.part' % file):
+				os.remove('%s.part' % file)
+		except OSError as e:
+			log('\033[1;31mE: %s\033[0m' % e)
+			if os.path.isfile(spare[1]):
+				os.remove(spare[1])
+		else:
+			if validators is not None:
+				validators.update(spare[2])
+			if response is not None:
+				response.update(spare[3])
+			return True
+	part = '%s.part' % file
+	headers = {'Accept-Encoding': 'identity'}
+	if check is not None:
+		if 'etag' in check:
+			headers['If-None-Match'] = check['etag']
+		if 'last_modified' in check:
+			headers['If-Modified-Since'] = check['last_modified']
+	if_range = None
 	for i in range(tries):
 		if i > 0:
-			print('\033[33mW: Retry: %d\033[0m' % i, file=sys.stderr)
+			log('\033[33mW: Retry: %d\033[0m' % i)
+			retry_wait(i, src)
 		try:
-			if interval > 0:
-				time.sleep(interval)
-			with closing(requests.get(src, stream=True)) as req:
+			offset = os.path.getsize(part) if os.path.isfile(part) else 0
+			h = headers
+			if offset > 0:
+				h = dict(headers, Range='bytes=%d-' % offset)
+				if if_range is not None:
+					# Only resumed if unchanged since the last try, otherwise the whole file is sent
+					h['If-Range'] = if_range
+			with closing(http_get(src, stream=True, headers=h)) as req:
 				sc = req.status_code
-				if sc == 200:
-					if size == 0:
-						try:
-							size = int(req.headers['content_length'])
-						except KeyError:
-							pass
-					if quiet or tqdm is None:
+				total = content_total(req)
+				if sc == 304:
+					add_stat('media_kept')
+					return True
+				elif sc == 416 and offset > 0:
+					if total != offset:
+						os.remove(part)
+						raise Exception('Server cannot resume %s' % src)
+				elif sc == 200 or sc == 206:
+					if sc == 206:
+						if content_start(req) != offset:
+							os.remove(part)
+							raise Exception('Server resumed %s at a wrong offset' % src)
+						add_stat('media_resumed')
+					else:
+						offset = 0
+					etag = req.headers.get('ETag')
+					if etag is not None and not etag.startswith('W/'):
+						if_range = etag
+					else:
+						if_range = req.headers.get('Last-Modified')
+					with open(part, 'ab' if sc == 206 else 'wb') as f, timed('request', metric_target(src)) as m:
+						# Reading the body counts towards the request, not as one more
+						m['count'] = 0
+						progress = getattr(job_local, 'progress', None)
 						for cb in req.iter_content(chunk_size=BUF_SIZE):
 							if cb[:23] == b'app:tiebaclient;type:0':
 								cb = cb[23:]
-							buf += cb
-					else:
-						with tqdm(
-								iterable=req.iter_content(chunk_size=BUF_SIZE),
-								desc='            GET', total=size, unit='B', unit_scale=True, unit_divisor=1024
-						) as progress:
-							for cb in progress.iterable:
-								if cb[:23] == b'app:tiebaclient;type:0':
-									cb = cb[23:]
-								buf += cb
-								progress.update(len(cb))
-					mt = mimetypes.guess_type(src.split('?')[0])[0]
-					if mt is None:
-						mt = fallback
-					return 'data:%s;base64,%s' % (mt, base64.b64encode(buf).decode('utf-8'))
+							s = f.write(cb)
+							if progress is not None:
+								progress.add(media_bytes=s)
+						length = f.tell()
+						m['size'] = length - offset
+					if total is not None and length < total:
+						raise Exception('Connection lost after %d of %d bytes at %s' % (length, total, src))
 				elif sc == 404:
-					print('\033[1;31mE: Server reported 404 at %s\033[0m' % src, file=sys.stderr)
-					return src
+					log('\033[1;31mE: Server reported 404 at %s\033[0m' % src)
+					return False
 				else:
 					raise Exception('Server reported %d at %s' % (req.status_code, src))
+				os.replace(part, file)
+				progress_add(media=1)
+				if validators is not None:
+					if 'ETag' in req.headers:
+						validators['etag'] = req.headers['ETag']
+					if 'Last-Modified' in req.headers:
+						validators['last_modified'] = req.headers['Last-Modified']
+					validators['length'] = os.path.getsize(file)
+				if response is not None:
+					response['status'] = 200 if sc == 206 or sc == 416 else sc
+					response['reason'] = 'OK' if sc == 206 or sc == 416 else req.reason
+					response['headers'] = list(req.headers.items())
+				return True
+		except Exception as e:
+			log('\033[1;31mE: %s\033[0m' % e)
+	return False
+
+
+def content_start(req):
+	# The offset of a partial response, from a Content-Range of "bytes START-END/TOTAL"
+	try:
+		return int(req.headers['Content-Range'].split()[1].split('-')[0])
+	except (KeyError, IndexError, ValueError):
+		return None
+
+
+def content_total(req):
+	# The size of the whole file, "*" in a Content-Range when unknown
+	if 'Content-Range' in req.headers:
+		try:
+			return int(req.headers['Content-Range'].rpartition('/')[2])
+		except ValueError:
+			return None
+	if req.status_code != 200:
+		return None
+	try:
+		return int(req.headers['Content-Length'])
+	except (KeyError, ValueError):
+		return None
+
+
+def join_media(fn):
+	# Waits for the background downloads of a thread, returns the sources that failed
+	with media_lock:
+		jobs = media_jobs.pop(fn, {})
+		media_names.pop(fn, None)
+		embed_keys.pop(fn, None)
+	failed = []
+	for file, (src, job) in jobs.items():
+		try:
+			ok = job.result()
 		except Exception as e:
-			print('\033[1;31mE: %s\033[0m' % e, file=sys.stderr)
-	return src
+			log('\033[1;31mE: %s\033[0m' % e)
+			ok = False
+		if not ok:
+			failed.append(src)
+	with media_lock:
+		# Left over when the file of a large media was already there and kept
+		spares = [src for src, spare in embed_spare.items() if spare[0] == fn]
+		spares = [embed_spare.pop(src)[1] for src in spares]
+	for spare in spares:
+		if os.path.isfile(spare):
+			os.remove(spare)
+	return failed
+
+
+@lru_cache(maxsize=4096)
+def text2emoticon(text):
+	# Emoticons are named by a prefix telling their set, followed by a number
+	if text[:14] == 'image_emoticon':
+		return EMOTICON_PREFIX + 'client/%s.png' % (text if len(text) > 14 else text + '1')
+	prefix = text.rstrip('0123456789')
+	number = text[len(prefix):]
+	if len(number) == 0:
+		return ''
+	if prefix == 'i_f':
+		return EMOTICON_PREFIX + 'face/%s.%s' % (text, 'gif' if int(number) > 50 else 'png')
+	try:
+		path, ext = EMOTICON_SETS[prefix]
+	except KeyError:
+		return ''
+	return EMOTICON_PREFIX + '%s/%s.%s' % (path, text, ext)
+
+
+def api_get(endpoint, params):
+	# Returns the body of a response along with the data parsed from it, so that no response is parsed twice
+	if source is not None:
+		# Only what was kept by earlier runs, the remote is never asked
+		data = source.response(
+			DUMP_KINDS[0 if endpoint == '/post_detail' else 1], params['tid'], params.get('pid', ''), int(params['page']))
+		if data is None:
+			return None, None
+		with timed('stage', 'parse'):
+			return data, json_loads(data)
+	data = cache_get(endpoint, params)
+	if data is not None:
+		try:
+			with timed('stage', 'parse'):
+				return data, json_loads(data)
+		except ValueError:
+			# Damaged in the cache, fetched again
+			pass
+	for i in range(tries):
+		if i > 0:
+			log('\033[33mW: Retry: %d\033[0m' % i)
+			retry_wait(i, remote + endpoint)
+		try:
+			req = http_get(remote + endpoint, params=params)
+			sc = req.status_code
+			if sc == 200:
+				data = req.content
+				with timed('stage', 'parse'):
+					parsed = json_loads(data)
+				cache_put(endpoint, params, data, parsed)
+				return data, parsed
+			elif sc == 404:
+				break
+		except (requests.RequestException, ValueError):
+			pass
+	return None, None
+
+
+def get_subs(thread, post, page=1, fn=''):
+	data, parsed = api_get('/subpost_detail', {'tid': thread, 'pid': post, 'page': str(page)})
+	if data is not None:
+		record_response(data, parsed, fn, 1, thread, pid=post, page=page)
+	return parsed
+
+
+def reply_count(post):
+	try:
+		return int(post['sub_post_number'])
+	except (KeyError, TypeError, ValueError):
+		return None
+
+
+def get_subpost_list(thread, post, fn=''):
+	# Returns every subpost of a post, using the reply count in post_detail to avoid needless requests
+	pid = post['id']
+	count = reply_count(post)
+	if count == 0:
+		add_stat('sub_avoided')
+		return []
+	if count is not None:
+		try:
+			embedded = post['sub_post_list']['sub_post_list']
+		except (KeyError, TypeError):
+			embedded = None
+		if type(embedded) == list and 0 < count <= len(embedded):
+			# Already complete in post_detail, neither the first nor the terminating empty page is needed
+			add_stat('sub_avoided', 2)
+			return embedded
+	try:
+		d0 = get_subs(thread, pid, fn=fn)
+		sdt = d0['subpost_list']
+	except (TypeError, ValueError, KeyError):
+		return []
+	if type(sdt) != list or len(sdt) == 0:
+		return []
+	total = 0
+	try:
+		total = int(d0['page']['total_page'])
+	except (KeyError, TypeError, ValueError):
+		pass
+	if total > 0:
+		# Pages after the first are fetched in parallel once the total is known
+		add_stat('sub_avoided')
+		if total > 1:
+			if sub_workers > 0:
+				pages = list(get_sub_page_pool().map(
+					in_context(lambda cp_s: get_subs(thread, pid, page=cp_s, fn=fn)), range(2, total + 1)))
+			else:
+				pages = (get_subs(thread, pid, page=cp_s, fn=fn) for cp_s in range(2, total + 1))
+			for page in pages:
+				try:
+					sdt += page['subpost_list']
+				except (TypeError, ValueError, KeyError):
+					pass
+	else:
+		cp_s = 1
+		while True:
+			if count is not None and len(sdt) >= count:
+				add_stat('sub_avoided')
+				break
+			cp_s += 1
+			try:
+				d1 = get_subs(thread, pid, page=cp_s, fn=fn)['subpost_list']
+			except (TypeError, ValueError, KeyError):
+				break
+			if type(d1) != list or len(d1) == 0:
+				break
+			sdt += d1
+	return sdt
+
+
+def get_json(thread, page=1, fn=''):
+	data, parsed = api_get('/post_detail', {'tid': thread, 'page': str(page)})
+	if data is not None:
+		record_response(data, parsed, fn, 0, thread, page=page)
+	return parsed
+
+
+def get_pages(thread, data, fn='', page=1):
+	# Yields the parsed pages of a thread in order, starting from the already fetched page PAGE
+	yield data
+	total = 0
+	try:
+		total = int(data['page']['total_page'])
+	except (KeyError, TypeError, ValueError):
+		pass
+	if page_workers > 0 and total > 1:
+		# Prefetch the remaining pages in a bounded window while earlier ones are being rendered
+		with ThreadPoolExecutor(max_workers=page_workers) as pool:
+			pending = deque()
+			cp = page + 1
+			try:
+				while cp <= total or len(pending) > 0:
+					while cp <= total and len(pending) < page_workers:
+						pending.append(pool.submit(in_context(get_json), thread, page=cp, fn=fn))
+						cp += 1
+					data = pending.popleft().result()
+					if type(data) != dict:
+						raise TypeError('Invalid data type, abandoned')
+					yield data
+			finally:
+				for future in pending:
+					future.cancel()
+	else:
+		cp = page
+		while total == 0 or cp < total:
+			cp += 1
+			data = get_json(thread, page=cp, fn=fn)
+			if type(data) != dict:
+				raise TypeError('Invalid data type, abandoned')
+			yield data
+
+
+def user_entry(user):
+	try:
+		return [user['name_show'], user['portrait']]
+	except KeyError:
+		return [user['name'], user['portrait']]
+
+
+def index_users(data):
+	# Authors of a page are looked up by id instead of walking user_list for every post and mention
+	users = {}
+	try:
+		for user in data['user_list']:
+			try:
+				users[user['id']] = user_entry(user)
+			except KeyError:
+				pass
+	except (KeyError, TypeError):
+		pass
+	data['user_index'] = users
+	with profiles_lock:
+		profiles.update(users)
+	return users
+
+
+def get_author(data, uid, fn=''):
+	users = data.get('user_index')
+	if users is None:
+		users = index_users(data)
+	author = users.get(uid)
+	if author is not None:
+		return author
+	body = None
+	with profiles_lock:
+		# Users seen in earlier pages or threads, including ones known to be missing
+		if uid in profiles:
+			author = profiles[uid]
+			if d_json or database is not None:
+				body = profile_bodies.get(uid)
+			if body is not None and fn not in profiles_recorded.setdefault(uid, set()):
+				profiles_recorded[uid].add(fn)
+			else:
+				return author
+	if body is not None:
+		# Fetched for another thread or an earlier run, this thread keeps its own copy
+		try:
+			record_response(body, json_loads(body), fn, 2, uid)
+		except ValueError:
+			pass
+		return author
+	author = None
+	known = False
+	params = {'uid': uid}
+	if source is not None:
+		jd = source.response(DUMP_KINDS[2], uid)
+		known = jd is not None
+	else:
+		jd = cache_get('/user_profile', params)
+		for i in range(tries if jd is None else 0):
+			if i > 0:
+				log('\033[33mW: Retry: %d\033[0m' % i)
+				retry_wait(i, remote + '/user_profile')
+			try:
+				req = http_get(remote + '/user_profile', params=params)
+			except requests.RequestException as e:
+				log('\033[33mW: %s\033[0m' % e)
+				continue
+			if req.status_code == 200:
+				jd = req.content
+				cache_put('/user_profile', params, jd)
+				break
+			elif req.status_code == 404:
+				known = True
+				break
+	if jd is not None:
+		known = True
+		try:
+			parsed = json_loads(jd)
+			record_response(jd, parsed, fn, 2, uid)
+			author = user_entry(parsed['user'])
+		except (KeyError, TypeError, ValueError):
+			pass
+	with profiles_lock:
+		profiles[uid] = author
+		if not known:
+			# Failed for now, missing for the rest of this run but asked again by the next one
+			return author
+		if jd is not None:
+			profile_bodies[uid] = jd
+			profiles_recorded.setdefault(uid, set()).add(fn)
+		# Missing users are remembered for a shorter time, they may still appear
+		resolved[uid] = (author, time.time() + (CACHE_TTL_USER if author is not None else CACHE_TTL_PAGE), jd)
+	return author
+
+
+def load_profiles(file):
+	try:
+		with open(file, 'rb') as f:
+			saved = json_loads(f.read())
+	except (OSError, ValueError):
+		return
+	now = time.time()
+	with profiles_lock:
+		for uid, entry in saved.items():
+			# Entries of older versions lack the response
+			author, expires = entry[:2]
+			body = entry[2].encode('utf-8') if len(entry) > 2 and entry[2] is not None else None
+			if expires > now:
+				profiles[uid] = author
+				resolved[uid] = (author, expires, body)
+				if body is not None:
+					profile_bodies[uid] = body
+
+
+def save_profiles(file):
+	with profiles_lock:
+		saved = {
+			uid: [author, expires, body.decode('utf-8', 'replace') if body is not None else None]
+			for uid, (author, expires, body) in resolved.items()}
+	tmp = '%s.tmp' % file
+	try:
+		with open(tmp, 'w') as f:
+			json.dump(saved, f)
+		os.replace(tmp, file)
+	except OSError as e:
+		log('\033[33mW: Cannot save user profiles: %s\033[0m' % e)
+
+
+def write_content_html(out, data, contents, sub=False, fn=''):
+	out('<html>')
+	out('<head>')
+	out('</head>')
+	out('<body>')
+	last = -1
+	i = 0
+	for content in contents:
+		i += 1
+		if type(content) != dict:
+			if verbosity > 1:
+				log('          * Content block %d/%d: NONE' % (i, len(contents)))
+			continue
+		c_type = int(content['type'])
+		if (last == 0 and c_type == 0 or last in (3, 5, 11) or last != -1 and c_type in (3, 5, 11)) and not sub:
+			out('<br/>')
+		renderer = RENDERERS.get(c_type)
+		if renderer is None:
+			# Not implemented
+			log('\033[33mW: Unimplemented content block: %s\033[0m' % content)
+			out('<span style="border: 1px solid red">%s</span>' % content)
+		else:
+			if verbosity > 1:
+				log('          * Content block %d/%d: \033[36m%s\033[0m' % (i, len(contents), renderer[0]))
+			renderer[1](out, data, content, fn)
+		last = c_type
+	out('</body>')
+	out('</html>')
+
+
+def thumbnail_src(content):
+	# The original image recovered from the address of one of its thumbnails
+	for key, start in (('cdn_src', 37), ('cdn_src_active', 38), ('big_cdn_src', 38)):
+		try:
+			src = content[key]
+		except KeyError:
+			continue
+		return src[start + 1 if src[5] == 's' else start:].split('&')[0]
+	return ''
+
+
+def media_length(content):
+	for key in ('size', 'origin_size'):
+		try:
+			return int(content[key])
+		except (KeyError, ValueError):
+			pass
+	return 0
+
+
+def render_text(out, data, content, fn):
+	# Plain text
+	out(content['text'].replace('\n', '<br/>'))
+
+
+def render_link(out, data, content, fn):
+	# Link, also used for topics
+	out(HTML_LINK % (content['link'], content['text']))
+
+
+def render_emoticon(out, data, content, fn):
+	src = text2emoticon(content['text'])
+	if len(src) > 0:
+		out(HTML_SMILEY)
+		write_src(out, 'src', src, fn, 'emoticon', fallback='image/png', overwrite=False, refs=True)
+		out(' alt="%s"/>' % content['c'])
+
+
+def render_image(out, data, content, fn):
+	# Images and graffiti
+	size = content['bsize'].split(sep=',') if 'bsize' in content else ['', '']
+	try:
+		src = content['graffiti_info']['url'] if int(content['type']) == 16 else content['origin_src']
+	except KeyError:
+		src = thumbnail_src(content)
+	out(HTML_IMAGE % (size[0], size[1]))
+	write_src(out, 'src', src, fn, 'image', fallback='image/jpeg', size=media_length(content), refs=True)
+	out('/>')
+
+
+def render_username(out, data, content, fn):
+	# Username (As link)
+	try:
+		author = get_author(data, content['uid'], fn=fn)
+		r = HTML_USER % (author[1], author[0]) if author is not None else content['text']
+	except KeyError:
+		r = content['text']
+	out(r)
+
+
+def render_video(out, data, content, fn):
+	# Video (Embedded or link)
+	text = content['text']
+	try:
+		link = content['link']
+		src = content['src']
+		size = [content['width'], content['height']]
+	except KeyError:
+		out(HTML_LINK % (text, text))
+		return
+	out('<video width="%s" height="%s"' % (size[0], size[1]))
+	write_src(out, 'poster', src, fn, 'poster', fallback='image/jpeg')
+	write_src(out, 'src', link, fn, 'video', fallback='video/mp4', size=media_length(content))
+	out(' controls/><br/><a href="%s">贴吧视频</a>' % text)
+
+
+def render_linebreak(out, data, content, fn):
+	out('<br/>')
+
+
+def render_number(out, data, content, fn):
+	# Number (As plain text)
+	out(content['text'])
+
+
+def render_sticker(out, data, content, fn):
+	# Big emoticons and emoticon graphs
+	size = [content['width'], content['height']] if 'width' in content and 'height' in content else ['', '']
+	src = ''
+	fb = 'image/png'
+	for key, mt in STICKER_SOURCES[int(content['type'])]:
+		if key in content:
+			src = content[key]
+			fb = mt
+			break
+	out(HTML_STICKER % (size[0], size[1]))
+	write_src(out, 'src', src, fn, 'big_emoticon', fallback=fb, overwrite=False, refs=True)
+	out('/>')
+
+
+# Content blocks by type, with the name they are reported as
+RENDERERS = {
+	0: ('TEXT', render_text),
+	1: ('LINK', render_link),
+	2: ('EMOTICON', render_emoticon),
+	3: ('IMAGE', render_image),
+	4: ('USERNAME', render_username),
+	5: ('VIDEO', render_video),
+	7: ('LINEBREAK', render_linebreak),
+	9: ('NUMBER', render_number),
+	11: ('BIG EMOTICON', render_sticker),
+	16: ('GRAFFITI', render_image),
+	18: ('TOPIC', render_link),
+	20: ('EMOTICON GRAPH', render_sticker),
+}
 
 
-def res2local(src, fn,  cat='', overwrite=True, size=0, quiet=False):
-	if src[:2] == '//':
-		src = 'http:' + src
-	if len(fn) == 0:
-		return src
-	dirname = '%s.html_files' % fn
-	pathname = os.path.join(output, dirname, cat)
-	os.makedirs(pathname, exist_ok=True)
-	filename = os.path.basename(src.split('?')[0])
-	file = os.path.join(pathname, filename)
-	if not overwrite and os.path.isfile(file):
-		return parse.quote(os.path.join(dirname, cat, filename))
-	for i in range(tries):
-		if i > 0:
-			print('\033[33mW: Retry: %d\033[0m' % i, file=sys.stderr)
-		try:
-			if interval > 0:
-				time.sleep(interval)
-			with closing(requests.get(src, stream=True, timeout=REQ_TIMEOUT)) as req:
-				sc = req.status_code
-				if sc == 200:
-					if size == 0:
-						try:
-							size = int(req.headers['content_length'])
-						except KeyError:
-							pass
-					with open(file, 'wb') as f:
-						if quiet or tqdm is None:
-							for cb in req.iter_content(chunk_size=BUF_SIZE):
-								if cb[:23] == b'app:tiebaclient;type:0':
-									cb = cb[23:]
-								f.write(cb)
-						else:
-							with tqdm(
-									iterable=req.iter_content(chunk_size=BUF_SIZE),
-									desc='            GET', total=size, unit='B', unit_scale=True, unit_divisor=1024
-							) as progress:
-								for cb in progress.iterable:
-									if cb[:23] == b'app:tiebaclient;type:0':
-										cb = cb[23:]
-									s = f.write(cb)
-									progress.update(s)
-					return parse.quote(os.path.join(dirname, cat, filename))
-				elif sc == 404:
-					print('\033[1;31mE: Server reported 404 at %s\033[0m' % src, file=sys.stderr)
-					return parse.quote(os.path.join(dirname, cat, filename)) if os.path.isfile(file) else src
-				else:
-					raise Exception('Server reported %d at %s' % (req.status_code, src))
-		except Exception as e:
-			print('\033[1;31mE: %s\033[0m' % e, file=sys.stderr)
-	return parse.quote(os.path.join(dirname, cat, filename)) if os.path.isfile(file) else src
+class HtmlWriter:
+	# Streams a page into a temporary file that replaces the destination only once complete; to stdout if no destination
+	def __init__(self, file, container=None):
+		self.file = file
+		self.container = container
+		if container is not None:
+			# Added to the container once complete, media entries are written in the meantime
+			self.f = tempfile.TemporaryFile('w+', encoding='utf-8')
+		elif file is None:
+			if jobs > 1:
+				# Pages of concurrent jobs are held back until complete so that they do not interleave
+				self.f = tempfile.TemporaryFile('w+', encoding='utf-8')
+			else:
+				self.f = sys.stdout
+		else:
+			self.f = open('%s.part' % file, 'w', encoding='utf-8')
 
+	def write(self, text):
+		self.f.write(text)
 
-def text2emoticon(text):
-	src = ''
-	# New
-	if text[:14] == 'image_emoticon':
-		src = 'https://tb2.bdstatic.com/tb/editor/images/client/%s.png' % (text if len(text) > 14 else text + '1')
-	# face
-	elif text[:3] == 'i_f' and str.isdecimal(text[3:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/face/%s.%s' % (text, 'gif' if int(text[3:]) > 50 else 'png')
-	# jd
-	elif text[:2] == 'j_' and str.isdecimal(text[2:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/jd/%s.png' % text
-	# bearchildren
-	elif text[:13] == 'bearchildren_' and str.isdecimal(text[13:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/bearchildren/%s.gif' % text
-	# tiexing
-	elif text[:8] == 'tiexing_' and str.isdecimal(text[8:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/tiexing/%s.gif' % text
-	# ali
-	elif text[:4] == 'ali_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/ali/%s.gif' % text
-	# luoluobu
-	elif text[:4] == 'llb_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/luoluobu/%s.gif' % text
-	# qpx_n
-	elif text[:1] == 'b' and str.isdecimal(text[1:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/qpx_n/%s.gif' % text
-	# xyj
-	elif text[:4] == 'xyj_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/xyj/%s.gif' % text
-	# lt
-	elif text[:4] == 'ltn_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/lt/%s.gif' % text
-	# bfmn
-	elif text[:5] == 'bfmn_' and str.isdecimal(text[5:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/bfmn/%s.gif' % text
-	# pczxh
-	elif text[:4] == 'zxh_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/pczxh/%s.gif' % text
-	# tsj
-	elif text[:2] == 't_' and str.isdecimal(text[2:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/tsj/%s.gif' % text
-	# wdj
-	elif text[:4] == 'wdj_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/wdj/%s.gif' % text
-	# lxs
-	elif text[:4] == 'lxs_' and str.isdecimal(text[4:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/lxs/%s.gif' % text
-	# baodong
-	elif text[:2] == 'b_' and str.isdecimal(text[2:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/baodong/%s.gif' % text
-	# baodong_d
-	elif text[:3] == 'bd_' and str.isdecimal(text[3:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/baodong_d/%s.gif' % text
-	# bobo
-	elif text[:2] == 'B_' and str.isdecimal(text[2:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/bobo/%s.gif' % text
-	# shadow
-	elif text[:3] == 'yz_' and str.isdecimal(text[3:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/shadow/%s.gif' % text
-	# ldw
-	elif text[:2] == 'w_' and str.isdecimal(text[2:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/ldw/%s.gif' % text
-	# 10th
-	elif text[:5] == '10th_' and str.isdecimal(text[5:]):
-		src = 'https://tb2.bdstatic.com/tb/editor/images/10th/%s.gif' % text
-	return src
+	def flush(self):
+		with timed('stage', 'write'):
+			self.f.flush()
 
+	def tell(self):
+		return self.f.tell() if self.file is not None else 0
 
-def get_subs(thread, post, page=1, fn=''):
-	for i in range(tries):
-		if i > 0:
-			print('\033[33mW: Retry: %d\033[0m' % i, file=sys.stderr)
-		try:
-			if interval > 0:
-				time.sleep(interval)
-			req = requests.get(remote + '/subpost_detail', params={'tid': thread, 'pid': post, 'page': str(page)})
-			sc = req.status_code
-			if sc == 200:
-				data = req.content
-				if d_json:
-					dump_json(data, fn, 1, thread, pid=post, page=page)
-				return data
-			elif sc == 404:
-				break
-		except requests.RequestException:
-			pass
-	return None
+	def copy(self, file, start, end):
+		# Carries a byte range of an earlier page over unchanged
+		self.f.flush()
+		with open(file, 'rb') as f, timed('stage', 'write'):
+			f.seek(start)
+			left = end - start
+			while left > 0:
+				cb = f.read(min(left, BUF_SIZE * 16))
+				if len(cb) == 0:
+					raise EOFError('%s is shorter than its manifest' % file)
+				self.f.buffer.write(cb)
+				left -= len(cb)
 
+	def commit(self, uri=None, name=None):
+		with timed('stage', 'write'):
+			if self.container is not None:
+				self.f.flush()
+				self.f.buffer.seek(0)
+				self.container.add_page(self.f.buffer, uri, name)
+				self.f.close()
+			elif self.file is not None:
+				self.f.close()
+				os.replace('%s.part' % self.file, self.file)
+			elif self.f is sys.stdout:
+				print(file=self.f, flush=True)
+			else:
+				self.f.seek(0)
+				with stdout_lock:
+					shutil.copyfileobj(self.f, sys.stdout)
+					print(flush=True)
+				self.f.close()
 
-def get_json(thread, page=1, fn=''):
-	for i in range(tries):
-		if i > 0:
-			print('\033[33mW: Retry: %d\033[0m' % i, file=sys.stderr)
-		try:
-			if interval > 0:
-				time.sleep(interval)
-			req = requests.get(remote + '/post_detail', params={'tid': thread, 'page': str(page)})
-			sc = req.status_code
-			if sc == 200:
-				data = req.content
-				if d_json:
-					dump_json(data, fn, 0, thread, page=page)
-				return data
-			elif sc == 404:
-				break
-		except requests.RequestException:
-			pass
-	return ''
+	def abort(self):
+		if self.f is not sys.stdout:
+			self.f.close()
+		if self.file is not None:
+			# What was fetched so far is kept for inspection
+			log('\033[33mW: Partial page left at %s.part\033[0m' % self.file)
 
 
-def get_author(data, uid, fn=''):
+def write_head(w, thread_title, thread_link, forum=None):
+	w('<!DOCTYPE html>\n')
+	w('<html lang="zh">\n')
+	w('\n')
+	w('<head>\n')
+	w('  <title>%s</title>\n' % thread_title)
+	w('  <meta charset="UTF-8">\n')
+	w('  <script>\n')
+	w('    function toggleLzl(thread_id) {\n')
+	w('      let x = document.getElementById(\'lzl\' + thread_id);\n')
+	w('      if (x.style.display === \'none\') {\n')
+	w('        x.style.display = \'block\';\n')
+	w('      } else {\n')
+	w('        x.style.display = \'none\';\n')
+	w('      }\n')
+	w('    }\n')
+	if embed and embed_refs:
+		w('    document.addEventListener(\'DOMContentLoaded\', function () {\n')
+		w('      document.querySelectorAll(\'[data-embed-ref]\').forEach(function (x) {\n')
+		w('        let y = document.querySelector(\'[data-embed-id="\' + x.dataset.embedRef + \'"]\');\n')
+		w('        if (y !== null) {\n')
+		w('          x.src = y.src;\n')
+		w('        }\n')
+		w('      });\n')
+		w('    });\n')
+	w('  </script>\n')
+	w('  <style>\n')
+	w('    .lzl {\n')
+	w('      border-style: solid;\n')
+	w('      border-width: thin;\n')
+	w('      border-color: #000000;\n')
+	w('    }\n')
+	w('    .usr {\n')
+	w('      text-decoration: none;\n')
+	w('      color: #000000;\n')
+	w('    }\n')
+	w('  </style>\n')
+	w('</head>\n')
+	w('\n')
+	w('<body>\n')
+	w('  <h1>%s</h1>\n' % thread_title)
+	if forum is not None:
+		w('  <div><a href="%s%s">%s吧</a> - <a href="%s">%s</a></div>\n' % (
+			TIEBA_FORUM_PREFIX, forum, forum, thread_link, thread_link))
+	else:
+		w('  <div><a href="%s">%s</a></div>\n' % (thread_link, thread_link))
+	w('  <hr />\n')
+	w('  \n')
+
+
+def load_manifest(file, thread, html):
+	# The manifest of an earlier run, if it still describes the page next to it
 	try:
-		for user in data['user_list']:
-			if uid == user['id']:
-				try:
-					return [user['name_show'], user['portrait']]
-				except KeyError:
-					return [user['name'], user['portrait']]
-	except KeyError:
-		pass
+		with open(file, 'rb') as f:
+			manifest = json_loads(f.read())
+		if manifest['tid'] != thread or manifest['options'] != [no_media, embed, embed_refs, no_sub]:
+			return None
+		if os.path.getsize(html) != manifest['size']:
+			log('\033[33mW: %s changed since it was fetched, fetching again\033[0m' % html)
+			return None
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+	return manifest
+
+
+def save_manifest(file, manifest):
+	tmp = '%s.tmp' % file
 	try:
-		if interval > 0:
-			time.sleep(interval)
-		req = requests.get(remote + '/user_profile', params={'uid': uid})
-		sc = req.status_code
-		if sc == 200:
-			jd = req.content
-			if d_json:
-				dump_json(jd, fn, 2, uid)
-			d0 = json.loads(jd)
-			user = d0['user']
-			try:
-				return [user['name_show'], user['portrait']]
-			except KeyError:
-				return [user['name'], user['portrait']]
-	except (KeyError, requests.RequestException):
-		pass
-	return None
+		with open(tmp, 'w') as f:
+			json.dump(manifest, f)
+		os.replace(tmp, file)
+	except OSError as e:
+		log('\033[33mW: Cannot save manifest: %s\033[0m' % e)
 
 
-def get_content_html(data, contents, sub=False, fn=''):
-	html_buf = '<html>'
-	html_buf += '<head>'
-	html_buf += '</head>'
-	html_buf += '<body>'
-	last = -1
-	i = 0
-	for content in contents:
-		i += 1
-		if not g_quiet:
-			print('          * Retrieving content blocks (%d/%d)... ' % (i, len(contents)), end='', file=sys.stderr)
-		if type(content) != dict:
-			if not g_quiet:
-				print('NONE', file=sys.stderr)
-			continue
-		c_type = int(content['type'])
-		if (last == 0 and c_type == 0 or last in (3, 5, 11) or last != -1 and c_type in (3, 5, 11)) and not sub:
-			html_buf += '<br/>'
-		if c_type == 0:
-			# Plain text
-			if not g_quiet:
-				print('\033[36mTEXT\033[0m detected' % content, file=sys.stderr)
-			text = str.replace(content['text'], '\n', '<br/>', -1)
-			html_buf += text
-		elif c_type == 1:
-			# Link
-			if not g_quiet:
-				print('\033[36mLINK\033[0m detected' % content, file=sys.stderr)
-			text = content['text']
-			link = content['link']
-			html_buf += '<a href="%s">%s</a>' % (link, text)
-		elif c_type == 2:
-			# Emoticon
-			if not g_quiet:
-				print('\033[36mEMOTICON\033[0m detected' % content, file=sys.stderr)
-			text = content['text']
-			alt = content['c']
-			src = text2emoticon(text)
-			if len(src) > 0:
-				html_buf += '<img class="BDE_Smiley" pic_type="1" width="30" height="30" src="%s" alt="%s"/>' % (
-					src if no_media else res2b64(src, fallback='image/png', quiet=True) if embed else res2local(
-						src, fn, cat='emoticon', overwrite=False, quiet=True), alt)
-		elif c_type == 3:
-			# Image
-			if not g_quiet:
-				print('\033[36mIMAGE\033[0m detected' % content, file=sys.stderr)
-			src = ''
-			size = ['', '']
-			length = 0
-			try:
-				size = content['bsize'].split(sep=',')
-			except KeyError:
-				pass
-			try:
-				src = content['origin_src']
-			except KeyError:
-				try:
-					src = content['cdn_src']
-					src = src[38 if src[5] == 's' else 37:].split('&')[0]
-				except KeyError:
-					try:
-						src = content['cdn_src_active']
-						src = src[39 if src[5] == 's' else 38:].split('&')[0]
-					except KeyError:
-						try:
-							src = content['big_cdn_src']
-							src = src[39 if src[5] == 's' else 38:].split('&')[0]
-						except KeyError:
-							pass
-			try:
-				length = int(content['size'])
-			except (KeyError, ValueError):
-				try:
-					length = int(content['origin_size'])
-				except (KeyError, ValueError):
-					pass
-			html_buf += '<img class="BDE_Image" pic_type="0" width="%s" height="%s" src="%s"/>' % (
-				size[0], size[1],
-				src if no_media else res2b64(src, fallback='image/jpeg', size=length) if embed else res2local(
-					src, fn, cat='image', size=length))
-		elif c_type == 4:
-			# Username (As link)
-			if not g_quiet:
-				print('\033[36mUSERNAME\033[0m detected' % content, file=sys.stderr)
-			text = content['text']
-			uid = content['uid']
-			try:
-				author = get_author(data, uid, fn=fn)
-				r = '<a href="%s%s" class="usr">%s</a>' % (
-					TIEBA_HOME_PREFIX, author[1], author[0]) if author is not None else text
-			except KeyError:
-				r = text
-			html_buf += r
-		elif c_type == 5:
-			# Video (Embedded or link)
-			if not g_quiet:
-				print('\033[36mVIDEO\033[0m detected' % content, file=sys.stderr)
-			text = content['text']
-			link = None
-			src = None
-			size = None
-			length = 0
+def fetch_thread(thread):
+	thread_fn = None
+	writer = None
+	progress = None
+	container = None
+	try:
+		# Fetched before its file name is known, dumped once it is
+		json_s, data = api_get('/post_detail', {'tid': thread, 'page': '1'})
+		if type(data) != dict:
+			raise TypeError('Invalid data type, abandoned')
+		# Common data
+		try:
+			#thread_title = data['thread']['thread_info']['title']
+			thread_title = data['thread']['title']
+		except KeyError:
 			try:
-				link = content['link']
-				src = content['src']
-				size = [content['width'], content['height']]
+				thread_title = data['thread']['thread_info']['title']
 			except KeyError:
-				pass
-			try:
-				length = int(content['size'])
-			except (KeyError, ValueError):
-				try:
-					length = int(content['origin_size'])
-				except (KeyError, ValueError):
-					pass
-			if link is None:
-				html_buf += '<a href="%s">%s</a>' % (text, text)
-			else:
-				html_buf += '<video width="%s" height="%s" poster="%s" src="%s" controls/><br/><a href="%s">贴吧视频</a>' % (
-					size[0], size[1],
-					src if no_media else res2b64(src, fallback='image/jpeg', size=length) if embed else res2local(
-						src, fn, cat='poster', size=length),
-					link if no_media else res2b64(link, fallback='video/mp4', size=length) if embed else res2local(
-						link, fn, cat='video', size=length),
-					text)
-		elif c_type == 7:
-			# Line break
-			if not g_quiet:
-				print('\033[36mLINEBREAK\033[0m detected' % content, file=sys.stderr)
-			text = '<br/>'
-			html_buf += text
-		elif c_type == 9:
-			# Number (As plain text)
-			if not g_quiet:
-				print('\033[36mNUMBER\033[0m detected' % content, file=sys.stderr)
-			text = content['text']
-			html_buf += text
-		elif c_type == 11:
-			# Big emoticon
+				raise Exception('Thread not accessible, abandoned')
+		thread_link = 'https://tieba.baidu.com/p/%s' % thread
+		ich = '[<\\\'|/"?*%>] '
+		thread_fn = ''.join([c for c in thread_title if c not in ich])
+		with fn_lock:
+			# Threads sharing a title must not write into each other's files
+			if thread_fn in active_fns:
+				thread_fn = '%s_%s' % (thread_fn, thread)
+			active_fns.add(thread_fn)
+		forum = None
+		record_response(json_s, data, thread_fn, 0, thread)
+		try:
+			forum = data['forum']['name']
+		except KeyError:
+			pass
+		if not g_quiet:
+			log('    Title is "%s"' % thread_title)
+		progress = job_local.progress = Progress(thread)
+		html = None
+		manifest_file = None
+		old = None
+		if container_format is not None:
+			container = ThreadContainer(
+				os.path.join(output, '%s.%s' % (thread_fn, CONTAINER_EXT[container_format])), container_format)
+			with media_lock:
+				containers[thread_fn] = container
+		elif not s_out:
+			html = os.path.join(output, '%s.html' % thread_fn)
+			manifest_file = os.path.join(output, '%s.manifest.json' % thread_fn)
+			if update:
+				old = load_manifest(manifest_file, thread, html)
+				if old is None and not g_quiet:
+					log('    No usable manifest, fetching the whole thread')
+		# Posts are indexed by id as [floor, page, replies, start, end], the latter two locating them in the page
+		index = {}
+		first = 1
+		max_floor = 0
+		splice = 0
+		if old is not None:
+			# Only the last page of the earlier run and the ones after it are fetched again
+			first = old['last_page']
+			splice = old['tail']
+			for pid, entry in old['posts'].items():
+				if entry[1] < first:
+					index[pid] = entry
+					max_floor = max(max_floor, entry[0])
+				else:
+					splice = min(splice, entry[3])
+			with media_lock:
+				# Names given to media files earlier must keep pointing at the same sources
+				media_names[thread_fn] = {(cat, name): src for cat, name, src in old['media']}
 			if not g_quiet:
-				print('\033[36mBIG EMOTICON\033[0m detected' % content, file=sys.stderr)
-			src = ''
-			size = ['', '']
-			fb = 'image/png'
-			try:
-				size = [content['width'], content['height']]
-			except KeyError:
-				pass
+				log('    Updating from page %d, after floor %d' % (first, max_floor))
+			if first > 1:
+				data = get_json(thread, page=first, fn=thread_fn)
+				if type(data) != dict:
+					raise TypeError('Invalid data type, abandoned')
+		# Generate html
+		writer = HtmlWriter(html, container)
+		w = writer.write
+		if old is None:
+			write_head(w, thread_title, thread_link, forum)
+		else:
+			writer.copy(html, 0, splice)
+		last_page = first
+		for cp, data in enumerate(get_pages(thread, data, fn=thread_fn, page=first), first):
+			pl = data['post_list']
+			if len(pl) == 0:
+				break
+			is_last = False
+			posts = []
+			for post in pl:
+				floor = int(post['floor'])
+				if floor <= max_floor:
+					is_last = True
+					break
+				max_floor = floor
+				posts.append(post)
+			if len(posts) > 0:
+				last_page = cp
 			try:
-				src = content['dynamic']
-				fb = 'image/gif'
-			except KeyError:
+				progress.add(pages=1, total=int(data['page']['total_page']))
+			except (KeyError, TypeError, ValueError):
+				progress.add(pages=1)
+			kept = [None] * len(posts)
+			if old is not None:
+				# Floors already in the page are carried over unless their replies changed
+				for n, post in enumerate(posts):
+					entry = old['posts'].get(post['id'])
+					if entry is not None and entry[2] is not None and entry[2] == reply_count(post):
+						kept[n] = entry
+			subs = None
+			if not no_sub and sub_workers > 0:
+				# Fetch subposts of every floor on this page at once, results are collected in floor order
+				subs = [get_sub_pool().submit(
+					in_context(get_subpost_list), thread, post, fn=thread_fn) if kept[n] is None else None
+					for n, post in enumerate(posts)]
+			for n, post in enumerate(posts):
+				floor = int(post['floor'])
+				start = writer.tell()
+				if kept[n] is not None:
+					writer.copy(html, kept[n][3], kept[n][4])
+					index[post['id']] = [floor, cp, kept[n][2], start, writer.tell()]
+					add_stat('floors_kept')
+					progress.add(floors=1)
+					continue
+				if verbosity > 0:
+					log('      - Reached floor %d in page %d' % (floor, cp))
+				author = None
+				an = '贴吧用户'
 				try:
-					src = content['static']
+					an = post['author_id']
+					author = get_author(data, an, fn=thread_fn)
 				except KeyError:
 					pass
-			html_buf += '<img class="BDE_Smiley" pic_type="0" width="%s" height="%s" src="%s"/>' % (
-				size[0], size[1],
-				src if no_media else res2b64(src, fallback=fb, quiet=True) if embed else res2local(
-					src, fn, cat='big_emoticon', overwrite=False, quiet=True))
-		elif c_type == 16:
-			# Graffiti
-			if not g_quiet:
-				print('\033[36mGRAFFITI\033[0m detected' % content, file=sys.stderr)
-			src = ''
-			size = ['', '']
-			length = 0
-			try:
-				size = content['bsize'].split(sep=',')
-			except KeyError:
-				pass
-			try:
-				src = content['graffiti_info']['url']
-			except KeyError:
+				th_time = 0
 				try:
-					src = content['cdn_src']
-					src = src[38 if src[5] == 's' else 37:].split('&')[0]
+					th_time = int(post['time'])
 				except KeyError:
-					try:
-						src = content['cdn_src_active']
-						src = src[39 if src[5] == 's' else 38:].split('&')[0]
-					except KeyError:
+					pass
+				w('  <div>\n')
+				w('    <div>\n')
+				w('      <div>%s #%d: <b>%s</b></div>\n' % (
+					time.strftime(TIME_STR, time.localtime(th_time)),
+					floor, '<a href="%s%s" class="usr">%s</a>' % (
+						TIEBA_HOME_PREFIX, author[1], author[0]) if author is not None else an))
+				w('      <div>')
+				with timed('stage', 'render'):
+					write_content_html(w, data, post['content'], fn=thread_fn)
+				w('</div>\n')
+				w('    </div>\n')
+				w('    \n')
+				sdt = None
+				if not no_sub:
+					sdt = subs[n].result() if subs is not None else get_subpost_list(thread, post, fn=thread_fn)
+				if type(sdt) == list and len(sdt) > 0:
+					progress.add(subposts=len(sdt))
+					if verbosity > 0:
+						log('        Subposts detected in floor %d' % floor)
+					w('    <button onclick="toggleLzl( %s )">收起回复</button>\n' % (post['id']))
+					w('    <div id="lzl%s" class="lzl">\n' % (post['id']))
+					w('      \n')
+					w('      \n')
+					for subpost in sdt:
+						st_time = 0
 						try:
-							src = content['big_cdn_src']
-							src = src[39 if src[5] == 's' else 38:].split('&')[0]
+							st_time = int(subpost['time'])
 						except KeyError:
 							pass
-			try:
-				length = int(content['size'])
-			except (KeyError, ValueError):
-				try:
-					length = int(content['origin_size'])
-				except (KeyError, ValueError):
-					pass
-			html_buf += '<img class="BDE_Image" pic_type="0" width="%s" height="%s" src="%s"/>' % (
-				size[0], size[1],
-				src if no_media else res2b64(src, fallback='image/jpeg', size=length) if embed else res2local(
-					src, fn, cat='image', size=length))
-		elif c_type == 18:
-			# Topic (As link)
-			if not g_quiet:
-				print('\033[36mTOPIC\033[0m detected' % content, file=sys.stderr)
-			text = content['text']
-			link = content['link']
-			html_buf += '<a href="%s">%s</a>' % (link, text)
-		elif c_type == 20:
-			# Emoticon graph (Yet another)
-			if not g_quiet:
-				print('\033[36mEMOTICON GRAPH\033[0m detected' % content, file=sys.stderr)
-			src = ''
-			size = ['', '']
-			fb = 'image/png'
-			try:
-				size = [content['width'], content['height']]
-			except KeyError:
-				pass
-			try:
-				src = content['src']
-				fb = 'image/jpeg'
-			except KeyError:
-				pass
-			html_buf += '<img class="BDE_Smiley" pic_type="0" width="%s" height="%s" src="%s"/>' % (
-				size[0], size[1],
-				src if no_media else res2b64(src, fallback=fb, quiet=True) if embed else res2local(
-					src, fn, cat='big_emoticon', overwrite=False, quiet=True))
+						au_po_s = ''
+						au_name_s = ''
+						if 'author' in subpost:
+							au_po_s = subpost['author']['portrait']
+							try:
+								au_name_s = subpost['author']['name_show']
+							except KeyError:
+								try:
+									au_name_s = subpost['author']['name']
+								except KeyError:
+									pass
+						else:
+							# Subposts embedded in post_detail only carry the author id
+							author_s = get_author(data, subpost.get('author_id'), fn=thread_fn)
+							if author_s is not None:
+								au_name_s, au_po_s = author_s
+						w('      <div>%s <b><a href="%s%s" class="usr">%s</a></b>: ' % (
+							time.strftime(TIME_STR, time.localtime(st_time)), TIEBA_HOME_PREFIX, au_po_s, au_name_s))
+						with timed('stage', 'render'):
+							write_content_html(w, data, subpost['content'], sub=True, fn=thread_fn)
+						w('</div>\n')
+						w('      \n')
+					w('    </div>\n')
+					w('    \n')
+				w('    <hr />\n')
+				w('  </div>\n')
+				w('  \n')
+				index[post['id']] = [floor, cp, reply_count(post), start, writer.tell()]
+				progress.add(floors=1)
+			writer.flush()
+			if is_last:
+				break
+		tail = writer.tell()
+		w('</body>\n')
+		w('\n')
+		w('</html>')
+		with media_lock:
+			names = media_names.get(thread_fn, {})
+		failed = join_media(thread_fn)
+		if len(failed) > 0:
+			add_stat('media_failed', len(failed))
+			log('\033[33mW: %d media file%s of thread %s failed to download\033[0m' % (
+				len(failed), 's' if len(failed) > 1 else '', thread))
+			for src in failed:
+				log('\033[33mW:   %s\033[0m' % src)
+		writer.commit(thread_link, '%s.html' % thread_fn)
+		writer = None
+		if container is not None:
+			container.close()
+			container = None
+		if manifest_file is not None:
+			save_manifest(manifest_file, {
+				'tid': thread, 'options': [no_media, embed, embed_refs, no_sub],
+				'last_page': last_page, 'max_floor': max_floor, 'size': os.path.getsize(html), 'tail': tail,
+				'posts': index, 'media': [[cat, name, src] for (cat, name), src in names.items()]})
+		elapsed = progress.close()
+		if not g_quiet:
+			log('    Fetched %s in %.1f s' % (progress.status(), elapsed))
+			log('    Thread %s successfully fetched' % thread)
+		return True
+	except Exception as e:
+		log('\033[1;31mE: %s\033[0m' % e)
+		return False
+	finally:
+		if progress is not None:
+			progress.close()
+			job_local.progress = None
+		if writer is not None:
+			writer.abort()
+		if thread_fn is not None:
+			join_media(thread_fn)
+			close_dump(thread_fn)
+			with media_lock:
+				containers.pop(thread_fn, None)
+			with fn_lock:
+				active_fns.discard(thread_fn)
+		if container is not None:
+			container.abort()
+
+
+def process_thread(thread, n, total, results):
+	if jobs > 1:
+		log_local.prefix = '[%s] ' % thread
+	if not g_quiet:
+		if total is None:
+			log('  * Processing thread %s (%d)...' % (thread, n))
 		else:
-			# Not implemented
-			if not g_quiet:
-				print('\033[33mFAILED\033[0m' % content, file=sys.stderr)
-			print('\033[33mW: Unimplemented content block: %s\033[0m' % content, file=sys.stderr)
-			html_buf += '<span style="border: 1px solid red">%s</span>' % content
-			pass
-		last = c_type
-	html_buf += '</body>'
-	html_buf += '</html>'
-	return html_buf
+			log('  * Processing thread %s (%d/%d)...' % (thread, n, total))
+	job_local.thread = thread
+	try:
+		with timed('stage', 'fetch'):
+			ok = fetch_thread(thread)
+		if metrics is not None:
+			metrics.add('thread', 'succeeded' if ok else 'failed')
+	finally:
+		job_local.thread = None
+	with results_lock:
+		results[0 if ok else 1].append(thread)
+
+
+def render_init(settings):
+	# Workers of the process pool start with the settings of the render command
+	global no_media
+	global no_sub
+	global g_quiet
+	global verbosity
+	global jobs
+	no_media, no_sub, g_quiet, verbosity, jobs = settings
+
+
+def render_thread(path, thread):
+	# Renders a thread from one dump, in a worker process
+	global source
+	global output
+	source = open_dump(path)
+	output = os.path.dirname(path)
+	if jobs > 1:
+		log_local.prefix = '[%s] ' % thread
+	if not g_quiet:
+		log('  * Rendering thread %s from %s...' % (thread, path))
+	job_local.thread = thread
+	try:
+		return fetch_thread(thread)
+	finally:
+		job_local.thread = None
+		source.close()
+		source = None
+
+
+def render_main(argv):
+	parser = argparse.ArgumentParser(
+		prog='%s render' % os.path.basename(sys.argv[0]),
+		description='Render threads again from the JSON dumped by earlier runs with -j, without contacting the remote')
+	parser.add_argument(
+		'-P', '--processes', dest='processes', type=int, default=os.cpu_count() or 1,
+		help='Render PROCESSES threads at once in separate processes, as many as there are CPUs by default')
+	parser.add_argument(
+		'-a', '--no-media', action='store_true', dest='no_media', default=False,
+		help='Refer to media files by their original addresses instead of the files downloaded earlier')
+	parser.add_argument(
+		'-p', '--no-subposts', action='store_true', dest='no_sub', default=False,
+		help='Do not render subposts')
+	parser.add_argument(
+		'-q', '--quiet', action='store_true', dest='g_quiet', default=False,
+		help='Do not print messages (except warnings or errors)')
+	parser.add_argument(
+		'-v', '--verbose', action='count', dest='verbosity', default=0,
+		help='Print every floor and subpost list reached; twice to also print every content block')
+	parser.add_argument(
+		dest='dumps', type=str, nargs='*',
+		help='Dumps to render, either .html_jsons directories or NDJSON streams, each next to the media files '
+			'and the page of its thread; directories holding dumps render all of them. The current directory by default')
+	args = parser.parse_args(argv)
+	processes = max(args.processes, 1)
+	jobs = []
+	for path in find_dumps(args.dumps if len(args.dumps) > 0 else ['.']):
+		try:
+			dump = open_dump(path)
+			jobs += [(path, thread) for thread in dump.threads()]
+			dump.close()
+		except (OSError, ValueError) as e:
+			log('\033[33mW: Cannot read %s: %s\033[0m' % (path, e))
+	if not args.g_quiet:
+		log('Rendering %d thread%s in %d process%s...' % (
+			len(jobs), 's' if len(jobs) != 1 else '', processes, 'es' if processes > 1 else ''))
+	settings = (args.no_media, args.no_sub, args.g_quiet, 0 if args.g_quiet else args.verbosity, processes)
+	results = ([], [])
+	with ProcessPoolExecutor(max_workers=processes, initializer=render_init, initargs=(settings,)) as pool:
+		futures = {pool.submit(render_thread, path, thread): thread for path, thread in jobs}
+		for future in as_completed(futures):
+			try:
+				ok = future.result()
+			except Exception as e:
+				log('\033[1;31mE: %s\033[0m' % e)
+				ok = False
+			results[0 if ok else 1].append(futures[future])
+	if len(results[1]) > 0:
+		log('\033[33mW: %d thread%s failed: %s\033[0m' % (
+			len(results[1]), 's' if len(results[1]) > 1 else '', ' '.join(results[1])))
+	if not args.g_quiet:
+		log('Complete. %d succeeded, %d failed.' % (len(results[0]), len(results[1])))
 
 
 def main():
+	if len(sys.argv) > 1 and sys.argv[1] == 'render':
+		# Threads are given by id, which never reads like a command
+		return render_main(sys.argv[2:])
 	# Get args
-	parser = argparse.ArgumentParser(description='Fetch threads from tieba using remotely hosted HibiAPI')
+	parser = argparse.ArgumentParser(
+		description='Fetch threads from tieba using remotely hosted HibiAPI',
+		epilog='Run "%(prog)s render -h" to see how to render threads again from dumped JSON')
 	parser.add_argument(
 		'-r', '--remote', dest='remote', type=str, default='https://api.obfs.dev/api/tieba',
 		help='Specify a remote hosting the HibiAPI daemon, "https://api.obfs.dev/api/tieba" by default')
 	parser.add_argument(
-		'-w', '--wait', dest='interval', type=int, default=0,
-		help='Wait for INTERVAL seconds in case there are anti-robot mechanisms')
+		'-w', '--wait', dest='interval', type=float, default=0,
+		help='Wait for INTERVAL seconds between requests to the remote in case there are anti-robot mechanisms, '
+			'a shorthand for a rate of 1/INTERVAL')
 	parser.add_argument(
 		'-t', '--tries', dest='tries', type=int, default=1,
 		help='Try TRIES times before giving up (except for 404 errors)')
+	parser.add_argument(
+		'--rate', dest='rates', type=str, action='append', default=[], metavar='[HOST=]RATE[:BURST]',
+		help='Send at most RATE requests per second to HOST, allowing bursts of BURST requests. '
+			'Applies to the remote if HOST is omitted. May be given multiple times')
+	parser.add_argument(
+		'--backoff', dest='backoff', type=float, default=BACKOFF,
+		help='Wait up to BACKOFF seconds before the first retry, doubling for each further retry, %d by default' % BACKOFF)
+	parser.add_argument(
+		'--backoff-max', dest='backoff_max', type=float, default=BACKOFF_MAX,
+		help='Never wait longer than BACKOFF_MAX seconds before a retry, %d by default' % BACKOFF_MAX)
+	parser.add_argument(
+		'--timeout', dest='timeout', type=float, default=REQ_TIMEOUT,
+		help='Give up a request if the server does not respond in TIMEOUT seconds, %d by default' % REQ_TIMEOUT)
+	parser.add_argument(
+		'--pool-hosts', dest='pool_hosts', type=int, default=POOL_HOSTS,
+		help='Keep connection pools for up to POOL_HOSTS hosts, %d by default' % POOL_HOSTS)
+	parser.add_argument(
+		'--pool-size', dest='pool_size', type=int, default=POOL_SIZE,
+		help='Keep up to POOL_SIZE alive connections per host, %d by default' % POOL_SIZE)
+	parser.add_argument(
+		'--cache-dir', dest='cache_dir', type=str, default=CACHE_DIR,
+		help='Keep responses of the remote in CACHE_DIR, "$XDG_CACHE_HOME/tieba-thread-fetcher" by default')
+	parser.add_argument(
+		'--cache-size', dest='cache_size', type=int, default=CACHE_SIZE,
+		help='Evict least recently used responses when the cache grows over CACHE_SIZE MiB, %d by default' % CACHE_SIZE)
+	parser.add_argument(
+		'--no-cache', action='store_true', dest='no_cache', default=False,
+		help='Do not cache responses of the remote')
+	parser.add_argument(
+		'--refresh', action='store_true', dest='refresh', default=False,
+		help='Ignore cached responses, but still cache new ones')
+	parser.add_argument(
+		'--jobs', dest='jobs', type=int, default=1,
+		help='Fetch up to JOBS threads at the same time, 1 by default')
+	parser.add_argument(
+		'--page-workers', dest='page_workers', type=int, default=0,
+		help='Prefetch up to PAGE_WORKERS pages concurrently while rendering. Pages are fetched one by one if not specified')
+	parser.add_argument(
+		'--sub-workers', dest='sub_workers', type=int, default=0,
+		help='Fetch subposts of up to SUB_WORKERS floors concurrently. Subposts are fetched one by one if not specified')
+	parser.add_argument(
+		'--media-workers', dest='media_workers', type=int, default=0,
+		help='Download up to MEDIA_WORKERS media files in background while rendering. '
+			'Media files are downloaded one by one if not specified')
 	parser.add_argument(
 		'-a', '--no-media', action='store_true', dest='no_media', default=False,
 		help='Do not fetch media files')
@@ -552,24 +2603,78 @@ def main():
 	parser.add_argument(
 		'-e', '--embed-media', action='store_true', dest='embed', default=False,
 		help='Embed media files into html')
+	parser.add_argument(
+		'--embed-cache-size', dest='embed_cache_size', type=int, default=EMBED_CACHE_SIZE,
+		help='Keep up to EMBED_CACHE_SIZE MiB of encoded media for repeated embeds, %d by default' % EMBED_CACHE_SIZE)
+	parser.add_argument(
+		'--embed-max-size', dest='embed_max', type=float, default=0,
+		help='Keep media files larger than EMBED_MAX MiB as local files instead of embedding them. No limit if not specified')
+	parser.add_argument(
+		'--embed-refs', action='store_true', dest='embed_refs', default=False,
+		help='Embed each image only once per page, repeated ones refer to the first copy (requires JavaScript to view)')
+	parser.add_argument(
+		'--container', dest='container', choices=('zip', 'warc'), default=None,
+		help='Write each thread with its media files into a single file: a zip holding the page and media files '
+			'as they would be laid out, or a gzipped WARC holding the page and the original responses of media files')
 	parser.add_argument(
 		'-o', '--output', dest='output', type=str, default='',
 		help='Specify a directory where the fetched files go. Uses working directory if not specified')
+	parser.add_argument(
+		'--revalidate', dest='revalidate', type=str, default='conditional',
+		choices=['conditional', 'head', 'trust', 'always'],
+		help='How media files downloaded by earlier runs are checked: "conditional" downloads them only if changed '
+			'on the server (default), "head" compares them with a HEAD request, "trust" keeps them without asking '
+			'the server, "always" downloads them again')
+	parser.add_argument(
+		'--media-store', dest='media_store', type=str, default=None,
+		help='Keep media files of every thread once in a content-addressed store at MEDIA_STORE, '
+			'linking them into the files of each thread. Media files already in the store are not fetched again')
+	parser.add_argument(
+		'-u', '--update', action='store_true', dest='update', default=False,
+		help='Only fetch floors added since the last run and floors whose replies changed, '
+			'merging them into the existing files. Uses the manifest written next to each file')
 	parser.add_argument(
 		'-s', '--stdout', action='store_true', dest='s_out', default=False,
 		help='Write to stdout')
 	parser.add_argument(
 		'-j', '--dump-jsons', action='store_true', dest='d_json', default=False,
 		help='Also dump the original JSON')
+	parser.add_argument(
+		'--dump-format', dest='dump_format', choices=('files', 'ndjson', 'ndjson.gz', 'ndjson.zst'), default=None,
+		help='Dump the original JSON as one file per response (files, by default with -j), '
+			'or as one NDJSON stream per thread with an index for random access, optionally compressed. Implies -j')
+	parser.add_argument(
+		'--sqlite', dest='sqlite', type=str, default=None,
+		help='Also keep threads, posts, subposts, users, media references and the original JSON in the SQLite database '
+			'SQLITE, updating what earlier runs kept')
+	parser.add_argument(
+		'--sqlite-media', action='store_true', dest='sqlite_media', default=False,
+		help='Also keep the content of media files in the database given by --sqlite')
+	parser.add_argument(
+		'--offline', action='store_true', dest='offline', default=False,
+		help='Render threads from the database given by --sqlite without contacting the remote, '
+			'media files are taken from earlier downloads or the database')
+	parser.add_argument(
+		'--metrics', dest='metrics', type=str, default=None,
+		help='Write time, counts and bytes of requests and stages, and counts of retries, for the run and for every thread, to METRICS as JSON')
+	parser.add_argument(
+		'--prometheus', dest='prometheus', type=str, default=None,
+		help='Write the metrics of the run to PROMETHEUS in the format of the Prometheus textfile collector')
+	parser.add_argument(
+		'--profile', dest='profile', type=str, default=None,
+		help='Profile the run with cProfile and write the stats to PROFILE, to be read with pstats')
 	parser.add_argument(
 		'-q', '--quiet', action='store_true', dest='g_quiet', default=False,
 		help='Do not print messages (except warnings or errors)')
+	parser.add_argument(
+		'-v', '--verbose', action='count', dest='verbosity', default=0,
+		help='Print every floor and subpost list reached; twice to also print every content block')
 	parser.add_argument(
 		dest='threads', type=str, nargs='+',
 		help='Threads to be fetched, in the format "tid"; Use "-" to use stdin and pass threads line by line')
 	args = parser.parse_args()
 	if sys.version_info < (3, 6):
-		print('\033[33mW: Running on python(<3.6) may cause error. Consider upgrading\033[0m', file=sys.stderr)
+		log('\033[33mW: Running on python(<3.6) may cause error. Consider upgrading\033[0m')
 	global remote
 	global interval
 	global tries
@@ -577,243 +2682,224 @@ def main():
 	global embed
 	global output
 	global d_json
+	global dump_format
+	global database
+	global source
+	global container_format
 	global g_quiet
+	global verbosity
+	global progress_bars
+	global timeout
+	global backoff
+	global backoff_max
+	global cache
+	global media_store
+	global revalidate
+	global embed_refs
+	global embed_cache
+	global embed_max
+	global store_links
+	global page_workers
+	global sub_workers
+	global media_workers
+	global jobs
+	global no_sub
+	global s_out
+	global update
+	global metrics
+	global profiler
 	interval = args.interval
 	tries = args.tries
 	if tries < 1:
 		tries = sys.maxsize
 	remote = args.remote
+	backoff = max(args.backoff, 0)
+	backoff_max = max(args.backoff_max, 0)
+	if interval > 0:
+		rates[parse.urlsplit(remote).netloc] = (1 / interval, 1)
+	for r in args.rates:
+		host, _, rate = r.rpartition('=')
+		if len(host) == 0:
+			host = parse.urlsplit(remote).netloc
+		rate, _, burst = rate.partition(':')
+		try:
+			rates[host] = (float(rate), int(burst) if len(burst) > 0 else 1)
+		except ValueError:
+			parser.error('invalid rate: %s' % r)
+	timeout = args.timeout if args.timeout > 0 else None
+	init_session(max(args.pool_hosts, 1), max(args.pool_size, 1))
+	if not args.no_cache:
+		try:
+			cache = ResponseCache(args.cache_dir, args.cache_size * 1048576, refresh=args.refresh)
+			if not args.refresh:
+				load_profiles(os.path.join(args.cache_dir, 'users.json'))
+		except OSError as e:
+			log('\033[33mW: Cache disabled: %s\033[0m' % e)
 	no_media = args.no_media
 	no_sub = args.no_sub
+	page_workers = max(args.page_workers, 0)
+	sub_workers = max(args.sub_workers, 0)
+	media_workers = max(args.media_workers, 0)
+	jobs = max(args.jobs, 1)
 	embed = args.embed
+	embed_refs = args.embed_refs
+	embed_cache = DataURICache(max(args.embed_cache_size, 0) * 1048576)
+	embed_max = int(max(args.embed_max, 0) * 1048576)
 	output = args.output
+	if args.media_store is not None:
+		media_store = args.media_store
+		os.makedirs(media_store, exist_ok=True)
+		try:
+			store_links = os.stat(media_store).st_dev == os.stat(output if len(output) > 0 else '.').st_dev
+		except OSError:
+			store_links = False
+	revalidate = args.revalidate
+	if not no_media and not embed:
+		load_media_index(os.path.join(output, MEDIA_INDEX))
 	s_out = args.s_out
-	d_json = args.d_json
+	update = args.update
+	if update and s_out:
+		parser.error('--update cannot be used with --stdout')
+	d_json = args.d_json or args.dump_format is not None
+	if args.dump_format is not None:
+		dump_format = args.dump_format
+	if dump_format == 'ndjson.zst' and zstandard is None:
+		parser.error('Install <zstandard> to dump with zstd compression')
+	if args.offline and args.sqlite is None:
+		parser.error('--offline requires --sqlite')
+	if args.container is not None:
+		for option, used in (('--embed-media', embed), ('--stdout', s_out), ('--update', update), (
+				'--media-store', media_store is not None)):
+			if used:
+				parser.error('--container cannot be used with %s' % option)
+		container_format = args.container
+	if args.sqlite is not None:
+		try:
+			database = ThreadDatabase(args.sqlite, blobs=args.sqlite_media)
+		except sqlite3.Error as e:
+			log('\033[1;31mE: Cannot open %s: %s\033[0m' % (args.sqlite, e))
+			exit(1)
+		if args.offline:
+			source = database
 	g_quiet = args.g_quiet
+	verbosity = 0 if g_quiet else args.verbosity
+	# Bars of concurrent jobs would garble each other, and make no sense where stderr is not a terminal
+	progress_bars = tqdm is not None and log_color and jobs == 1 and not g_quiet
 	threads = args.threads
 	s_in = '-' in threads
-	if not g_quiet:
-		print('Connecting to remote HibiAPI daemon... ', end='', file=sys.stderr)
-	for i in range(tries):
-		if i > 0:
-			if g_quiet:
-				print('\033[33mW: Retry: %d\033[0m' % i, file=sys.stderr)
-			else:
-				print('\033[33mW: Retry: %d\033[0m ... ' % i, end='', file=sys.stderr)
-		try:
-			if interval > 0:
-				time.sleep(interval)
-			req = requests.get(remote)
-			sc = req.status_code
-			if sc == 422:
-				if not g_quiet:
-					print('\033[1;32mSUCCESS\033[0m', file=sys.stderr)
-				break
-			else:
-				if sc == 404:
+	if args.metrics is not None or args.prometheus is not None:
+		metrics = Metrics()
+	if args.profile is not None:
+		profiler = cProfile.Profile()
+		profiler.enable()
+	if source is None:
+		if not g_quiet:
+			log('Connecting to remote HibiAPI daemon... ', end='')
+		for i in range(tries):
+			if i > 0:
+				if g_quiet:
+					log('\033[33mW: Retry: %d\033[0m' % i)
+				else:
+					log('\033[33mW: Retry: %d\033[0m ... ' % i, end='')
+				retry_wait(i, remote)
+			try:
+				req = http_get(remote)
+				sc = req.status_code
+				if sc == 422:
 					if not g_quiet:
-						print('\033[1;31mFAILED\033[0m', file=sys.stderr)
-					print('\033[1;31mE: Server reported 404 at %s\033[0m' % remote, file=sys.stderr)
+						log('\033[1;32mSUCCESS\033[0m')
+					break
+				else:
+					if sc == 404:
+						if not g_quiet:
+							log('\033[1;31mFAILED\033[0m')
+						log('\033[1;31mE: Server reported 404 at %s\033[0m' % remote)
+						exit(1)
+					raise AttributeError('Invalid remote daemon')
+			except Exception as e:
+				if not g_quiet:
+					log('\033[1;31mFAILED\033[0m')
+				log('\033[1;31mE: %s\033[0m' % e)
+				if i == tries - 1:
 					exit(1)
-				raise AttributeError('Invalid remote daemon')
-		except Exception as e:
-			if not g_quiet:
-				print('\033[1;31mFAILED\033[0m', file=sys.stderr)
-			print('\033[1;31mE: %s\033[0m' % e, file=sys.stderr)
-			if i == tries - 1:
-				exit(1)
 	# Parse jsons
 	if s_in:
 		if not g_quiet:
-			print('Accepting threads...', file=sys.stderr)
+			log('Accepting threads...')
 	else:
 		if not g_quiet:
-			print('Fetching %d thread%s....' % (len(threads), 's' if len(threads) > 1 else ''), file=sys.stderr)
+			log('Fetching %d thread%s....' % (len(threads), 's' if len(threads) > 1 else ''))
 	i = 0
+	results = ([], [])
+	pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+	slots = threading.BoundedSemaphore(jobs)
 	for thread in (sys.stdin if s_in else threads):
 		thread = thread.rstrip()
 		if not thread.isdecimal():
-			print('\033[1;31mE: Illegal thread %s\033[0m' % thread, file=sys.stderr)
+			log('\033[1;31mE: Illegal thread %s\033[0m' % thread)
 			continue
 		if s_in:
 			if thread == '':
 				break
-			if not g_quiet:
-				print('  * Processing thread %s (%d)...' % (thread, i + 1), file=sys.stderr)
+		i += 1
+		if pool is None:
+			process_thread(thread, i, None if s_in else len(threads), results)
 		else:
-			if not g_quiet:
-				print('  * Processing thread %s (%d/%d)...' % (thread, i + 1, len(threads)), file=sys.stderr)
-		try:
-			json_s = get_json(thread)
-			data = json.loads(json_s)
-			if type(data) != dict:
-				raise TypeError('Invalid data type, abandoned')
-			# Common data
-			try:
-				#thread_title = data['thread']['thread_info']['title']
-				thread_title = data['thread']['title']
-			except KeyError:
-				try:
-					thread_title = data['thread']['thread_info']['title']
-				except KeyError:
-					raise Exception('Thread not accessible, abandoned')
-			thread_link = 'https://tieba.baidu.com/p/%s' % thread
-			ich = '[<\\\'|/"?*%>] '
-			thread_fn = ''.join([c for c in thread_title if c not in ich])
-			forum = None
-			if d_json:
-				dump_json(json_s, thread_fn, 0, thread)
+			# Only read further threads when a job slot is free, so stdin keeps streaming
+			slots.acquire()
+			job = pool.submit(in_context(process_thread), thread, i, None if s_in else len(threads), results)
+			job.add_done_callback(lambda j: slots.release())
+	if pool is not None:
+		pool.shutdown(wait=True)
+	for fn in list(dump_streams):
+		# Left open by responses of a thread that failed arriving late
+		close_dump(fn)
+	if database is not None:
+		database.close()
+	if cache is not None:
+		save_profiles(os.path.join(cache.path, 'users.json'))
+	if len(media_index) > 0:
+		save_media_index(os.path.join(output, MEDIA_INDEX))
+	if profiler is not None:
+		profiler.disable()
+		profile = pstats.Stats(profiler)
+		for worker in profilers:
 			try:
-				forum = data['forum']['name']
-			except KeyError:
+				profile.add(worker)
+			except TypeError:
+				# Never ran anything
 				pass
-			if not g_quiet:
-				print('    Title is "%s"' % thread_title, file=sys.stderr)
-			# Generate html
-			buf = '<!DOCTYPE html>\n'
-			buf += '<html lang="zh">\n'
-			buf += '\n'
-			buf += '<head>\n'
-			buf += '  <title>%s</title>\n' % thread_title
-			buf += '  <meta charset="UTF-8">\n'
-			buf += '  <script>\n'
-			buf += '    function toggleLzl(thread_id) {\n'
-			buf += '      let x = document.getElementById(\'lzl\' + thread_id);\n'
-			buf += '      if (x.style.display === \'none\') {\n'
-			buf += '        x.style.display = \'block\';\n'
-			buf += '      } else {\n'
-			buf += '        x.style.display = \'none\';\n'
-			buf += '      }\n'
-			buf += '    }\n'
-			buf += '  </script>\n'
-			buf += '  <style>\n'
-			buf += '    .lzl {\n'
-			buf += '      border-style: solid;\n'
-			buf += '      border-width: thin;\n'
-			buf += '      border-color: #000000;\n'
-			buf += '    }\n'
-			buf += '    .usr {\n'
-			buf += '      text-decoration: none;\n'
-			buf += '      color: #000000;\n'
-			buf += '    }\n'
-			buf += '  </style>\n'
-			buf += '</head>\n'
-			buf += '\n'
-			buf += '<body>\n'
-			buf += '  <h1>%s</h1>\n' % thread_title
-			if forum is not None:
-				buf += '  <div><a href="%s%s">%s吧</a> - <a href="%s">%s</a></div>\n' % (
-					TIEBA_FORUM_PREFIX, forum, forum, thread_link, thread_link)
-			else:
-				buf += '  <div><a href="%s">%s</a></div>\n' % (thread_link, thread_link)
-			buf += '  <hr />\n'
-			buf += '  \n'
-			is_last = False
-			max_floor = 0
-			cp = 1
-			while not is_last:
-				pl = data['post_list']
-				if len(pl) == 0:
-					break
-				for post in pl:
-					floor = int(post['floor'])
-					if floor <= max_floor:
-						is_last = True
-						break
-					if not g_quiet:
-						print('      - Reached floor %d in page %d' % (floor, cp), file=sys.stderr)
-					max_floor = floor
-					author = None
-					an = '贴吧用户'
-					try:
-						an = post['author_id']
-						author = get_author(data, an, fn=thread_fn)
-					except KeyError:
-						pass
-					th_time = 0
-					try:
-						th_time = int(post['time'])
-					except KeyError:
-						pass
-					buf += '  <div>\n'
-					buf += '    <div>\n'
-					buf += '      <div>%s #%d: <b>%s</b></div>\n' % (
-						time.strftime(TIME_STR, time.localtime(th_time)),
-						floor, '<a href="%s%s" class="usr">%s</a>' % (
-							TIEBA_HOME_PREFIX, author[1], author[0]) if author is not None else an)
-					buf += '      <div>%s</div>\n' % (
-						get_content_html(
-							data, post['content'], fn=thread_fn))
-					buf += '    </div>\n'
-					buf += '    \n'
-					sdt = None
-					if not no_sub:
-						try:
-							sdt = json.loads(get_subs(thread, post['id'], fn=thread_fn))['subpost_list']
-						except (ValueError, KeyError):
-							pass
-					if type(sdt) == list and len(sdt) > 0:
-						if not g_quiet:
-							print('        Subposts detected in floor %d' % floor, file=sys.stderr)
-						buf += '    <button onclick="toggleLzl( %s )">收起回复</button>\n' % (post['id'])
-						buf += '    <div id="lzl%s" class="lzl">\n' % (post['id'])
-						buf += '      \n'
-						buf += '      \n'
-						cp_s = 1
-						ii = 0
-						while len(sdt) > 0:
-							for subpost in sdt:
-								st_time = 0
-								try:
-									st_time = int(subpost['time'])
-								except KeyError:
-									pass
-								au_po_s = subpost['author']['portrait']
-								au_name_s = ''
-								try:
-									au_name_s = subpost['author']['name_show']
-								except KeyError:
-									try:
-										au_name_s = subpost['author']['name']
-									except KeyError:
-										pass
-								buf += '      <div>%s <b><a href="%s%s" class="usr">%s</a></b>: %s</div>\n' % (
-									time.strftime(TIME_STR, time.localtime(st_time)), TIEBA_HOME_PREFIX, au_po_s,
-									au_name_s, get_content_html(
-										data, subpost['content'], sub=True, fn=thread_fn))
-								buf += '      \n'
-								ii += 1
-							cp_s += 1
-							try:
-								sdt = json.loads(get_subs(thread, post['id'], page=cp_s, fn=thread_fn))['subpost_list']
-							except (ValueError, KeyError):
-                                sdt = []
-								pass
-						buf += '    </div>\n'
-						buf += '    \n'
-					buf += '    <hr />\n'
-					buf += '  </div>\n'
-					buf += '  \n'
-				cp += 1
-				data = json.loads(get_json(thread, page=cp, fn=thread_fn))
-				if type(data) != dict:
-					raise TypeError('Invalid data type, abandoned')
-			buf += '</body>\n'
-			buf += '\n'
-			buf += '</html>'
-			if s_out:
-				print(buf)
-			else:
-				with open(os.path.join(output, '%s.html' % thread_fn), 'w') as f:
-					f.write(buf)
-					sys.stdout.flush()
-			if not g_quiet:
-				print('    Thread %s successfully fetched' % thread, file=sys.stderr)
-		except Exception as e:
-			print('\033[1;31mE: %s\033[0m' % e, file=sys.stderr)
-		i += 1
+		profile.dump_stats(args.profile)
+	try:
+		if args.metrics is not None:
+			metrics.write_json(args.metrics)
+		if args.prometheus is not None:
+			metrics.write_prometheus(args.prometheus)
+	except OSError as e:
+		log('\033[33mW: Cannot write metrics: %s\033[0m' % e)
+	if len(results[1]) > 0:
+		log('\033[33mW: %d thread%s failed: %s\033[0m' % (
+			len(results[1]), 's' if len(results[1]) > 1 else '', ' '.join(results[1])))
 	if not g_quiet:
-		print('Complete.', file=sys.stderr)
+		if stats.get('sub_avoided', 0) > 0:
+			log('Avoided %d subpost requests using reply counts' % stats['sub_avoided'])
+		if stats.get('floors_kept', 0) > 0:
+			log('Kept %d floors from earlier runs' % stats['floors_kept'])
+		if stats.get('cache_hits', 0) > 0:
+			log('Served %d responses from cache' % stats['cache_hits'])
+		if stats.get('media_resumed', 0) > 0:
+			log('Resumed %d interrupted downloads' % stats['media_resumed'])
+		if stats.get('media_kept', 0) > 0:
+			log('Kept %d media files downloaded earlier' % stats['media_kept'])
+		if stats.get('store_hits', 0) + stats.get('store_dedup', 0) > 0:
+			log('Reused %d media files from the store, %d downloads had content already stored' % (
+				stats.get('store_hits', 0), stats.get('store_dedup', 0)))
+		if stats.get('embed_hits', 0) + stats.get('embed_refs', 0) > 0:
+			log('Reused %d encoded media files, %d embeds refer to an earlier copy' % (
+				stats.get('embed_hits', 0), stats.get('embed_refs', 0)))
+		if stats.get('media_failed', 0) > 0:
+			log('%d media files failed to download' % stats['media_failed'])
+		log('Complete. %d succeeded, %d failed.' % (len(results[0]), len(results[1])))
 
 
 if __name__ == "__main__":